@@ -2,24 +2,53 @@
 
 import os
 import time
-import pickle
+import sqlite3
+from contextlib import closing
 from datetime import datetime
 import logging
 from sys import stdout
 from pprint import pformat
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
 
 from rdflib.namespace import RDF, RDFS, OWL, XSD
 from beets.library import Library
 from pyswip.prolog import Prolog
+from sqlitedict import SqliteDict
 
 from util.rdf import discogs
 from util.rdf.namespaces import B3, XCAT
-from util.rdf.b3 import file_hash, hashlist_hash
-from util.rdf.pl import (xsd_type, LDateTime, entries_to_dir,
-                         TrackList, rdf_unify, RPQ, nometa_file_node)
+from util.rdf.b3 import HashCache, hash_tree, hashlist_hash
+from util.rdf.pl import (xsd_type, escape_string, LDateTime, entries_to_dir,
+                         LabelIndex, RPQ, TripleLoader, nometa_file_node)
 from util.log import LogFormatter
 
+# {release: (beets album id, [(disc, track num, track)])} of the tracks
+# imported for each release still without a tracklist
 release_dict = {}
+# releases asserted this run, which may not be flushed to the store yet
+loaded_releases = set()
+
+
+class TripleList(list):
+    """Triples built for the writer, with the add() of a TripleLoader."""
+    def add(self, subj, pred, obj):
+        self.append((subj, pred, obj))
+
+
+class Labelled(namedtuple('Labelled', 'type label')):
+    """Resource of rdf:type type with xcat:name label, left for the writer
+    to resolve to an existing resource or a new bnode."""
+
+
+class Date(namedtuple('Date', 'fields')):
+    """LDateTime of the (name, value) fields, left for the writer."""
+
+
+BuiltTrack = namedtuple('BuiltTrack', 'file_uri track disc track_num album_id '
+                        'release triples release_triples')
+
 
 def discogs_url(key, value):
     base = "http://www.discogs.com/"
@@ -41,12 +70,9 @@ def mb_url(key, value):
         return (base + 'release/' + str(value))
 
 
-def release_from_beets(rpq, release_uri, source, _beets):
-    release_lbl = xsd_type(_beets['album'], 'string')
-    rpq.rassert(*[
-        f"rdf_assert('{release_uri}', '{RDF.type}', '{XCAT.Release}')",
-        f"rdf_assert('{release_uri}', '{XCAT.title}', {release_lbl})",
-    ])
+def release_from_beets(triples, release_uri, source, _beets):
+    triples.add(release_uri, RDF.type, XCAT.Release)
+    triples.add(release_uri, XCAT.title, xsd_type(_beets['album'], 'string'))
 
     albumartist_lbl = xsd_type(_beets['albumartist'], 'string')
     label_uri = None
@@ -72,49 +98,40 @@ def release_from_beets(rpq, release_uri, source, _beets):
         print("what source?", source, release_uri)
 
     if not albumartist:
-        albumartist = rpq.simple_query(
-                f"rdf(X, '{RDF.type}', '{XCAT.Artist}'), "
-                f"rdf(X, '{XCAT.Name}', {albumartist_lbl})") or rpq.new_bnode()
-        if isinstance(albumartist, list):
-            albumartist = rdf_unify(rpq, albumartist)
-
-    rpq.rassert(*[
-        f"rdf_assert('{albumartist}', '{RDF.type}', '{XCAT.Artist}')",
-        f"rdf_assert('{albumartist}', '{XCAT.name}', {albumartist_lbl})",
-        f"rdf_assert('{release_uri}', '{XCAT.maker}', '{albumartist}')",
-        f"rdf_assert('{albumartist}', '{XCAT.made}', '{release_uri}')"
-    ])
+        albumartist = Labelled(XCAT.Artist, albumartist_lbl)
+
+    triples.add(albumartist, RDF.type, XCAT.Artist)
+    triples.add(albumartist, XCAT.name, albumartist_lbl)
+    triples.add(release_uri, XCAT.maker, albumartist)
+    triples.add(albumartist, XCAT.made, release_uri)
 
     if (year := _beets['year']):
         month = _beets.get('month')
         day = _beets.get('day')
-        published_in = LDateTime(rpq, year=year, month=month, day=day)
-        rpq.rassert(
-            f"rdf_assert('{release_uri}', '{XCAT.published_during}', "
-            f"'{published_in}')"
-        )
+        published_in = Date((('year', year), ('month', month), ('day', day)))
+        triples.add(release_uri, XCAT.published_during, published_in)
 
-    add_genres(rpq, release_uri, _beets)
+    add_genres(triples, release_uri, _beets)
 
     if label_uri:
-        label_lbl = xsd_type(_beets['label'], 'string')
-        rpq.rassert(*[
-            f"rdf_assert('{label_uri}', '{RDF.type}', '{XCAT.MusicLabel}')",
-            f"rdf_assert('{label_uri}', '{XCAT.name}', {label_lbl})",
-            f"rdf_assert('{label_uri}', '{XCAT.published}', '{release_uri}')",
-            f"rdf_assert('{release_uri}', '{XCAT.publisher}', '{label_uri}')",
-        ])
+        triples.add(label_uri, RDF.type, XCAT.MusicLabel)
+        triples.add(label_uri, XCAT.name, xsd_type(_beets['label'], 'string'))
+        triples.add(label_uri, XCAT.published, release_uri)
+        triples.add(release_uri, XCAT.publisher, label_uri)
 
         if _beets['catalognum']:
-            cat_num = xsd_type(_beets['catalognum'], 'string')
-            rpq.rassert(f"rdf_assert('{release_uri}', '{XCAT.catalog_num}',"
-                        f" {cat_num})")
+            triples.add(release_uri, XCAT.catalog_num,
+                        xsd_type(_beets['catalognum'], 'string'))
 
 
-def track_from_beets(rpq, beets_lib, data):
-    # check if track is already in db
+def track_from_beets(data, album=None):
+    """Build the triples of a beets item, and of its album if given.
 
-    global release_dict
+    Only plain python, so it can run in a worker process. Resources looked
+    up by label and LDateTimes are left as Labelled and Date terms for
+    write_track to resolve.
+    """
+    triples = TripleList()
     file_URN = B3[data['_hash']]
     file_path = xsd_type(data['path'], 'string')
     encoding = xsd_type(data['format'], 'string')
@@ -122,13 +139,10 @@ def track_from_beets(rpq, beets_lib, data):
     mtime = datetime.fromtimestamp(data['_mtime'])
 
     ## Add the file
-    rpq.rassert(*[
-        f"rdf_assert('{file_URN}', '{RDF.type}', '{XCAT.AudioFile}')",
-        f"rdf_assert('{file_URN}', '{XCAT.encoding}', {encoding})",
-        f"rdf_assert('{file_URN}', '{XCAT.path}', {file_path})",
-        f"rdf_assert('{file_URN}', '{XCAT.hash}',"
-        f" {xsd_type(data['_hash'], 'string')})"
-    ])
+    triples.add(file_URN, RDF.type, XCAT.AudioFile)
+    triples.add(file_URN, XCAT.encoding, encoding)
+    triples.add(file_URN, XCAT.path, file_path)
+    triples.add(file_URN, XCAT.hash, xsd_type(data['_hash'], 'string'))
 
     ## Define resources URI's depending on data source
     source = data.get('data_source')
@@ -151,11 +165,7 @@ def track_from_beets(rpq, beets_lib, data):
         if data['label'] == data['artist']:
             artist = data['mb_artistid']
         else:
-            artist = rpq.simple_query(
-                    f"rdf(X, '{RDF.type}', '{XCAT.Artist}'), "
-                    f"rdf(X, '{XCAT.name}', {artist_lbl})") or rpq.new_bnode()
-            if isinstance(artist, list):
-                artist = rdf_unify(rpq, artist)
+            artist = Labelled(XCAT.Artist, artist_lbl)
         release = data['mb_albumid']
         track = data['mb_trackid']
     elif data_source is None:
@@ -163,93 +173,97 @@ def track_from_beets(rpq, beets_lib, data):
         pass
 
     ## Add the mtime
-    mtime_term = LDateTime(rpq, year=mtime.year, month=mtime.month,
-                           day=mtime.day, hour=mtime.hour)
-
-    rpq.rassert(*[
-        f"rdf_assert('{artist}', '{RDF.type}', '{XCAT.Artist}')",
-        f"rdf_assert('{artist}', '{XCAT.name}', {artist_lbl})",
-        f"rdf_assert('{track}', '{RDF.type}', '{XCAT.Recording}')",
-        f"rdf_assert('{track}', '{XCAT.file}', '{file_URN}')",
-        f"rdf_assert('{file_URN}', '{XCAT.recording}', '{track}')",
-        f"rdf_assert('{track}', '{XCAT.title}', {track_lbl})",
-        f"rdf_assert('{track}', '{XCAT.added_during}', '{mtime_term}')",
-        f"rdf_assert('{track}', '{XCAT.released_on}', '{release}')",
-        f"rdf_assert('{track}', '{XCAT.maker}', '{artist}')",
-        f"rdf_assert('{artist}', '{XCAT.made}', '{track}')",
-    ])
+    mtime_term = Date((('year', mtime.year), ('month', mtime.month),
+                       ('day', mtime.day), ('hour', mtime.hour)))
+
+    triples.add(artist, RDF.type, XCAT.Artist)
+    triples.add(artist, XCAT.name, artist_lbl)
+    triples.add(track, RDF.type, XCAT.Recording)
+    triples.add(track, XCAT.file, file_URN)
+    triples.add(file_URN, XCAT.recording, track)
+    triples.add(track, XCAT.title, track_lbl)
+    triples.add(track, XCAT.added_during, mtime_term)
+    triples.add(track, XCAT.released_on, release)
+    triples.add(track, XCAT.maker, artist)
+    triples.add(artist, XCAT.made, track)
 
     ## Add the genres
-    add_genres(rpq, track, data)
+    add_genres(triples, track, data)
 
     ## Add the release
-    if (not rpq.boolquery(f"rdf('{release}', '{RDF.type}', '{XCAT.Release}')")
-            and data['album_id']):
-        beetz_release = beets_lib.get_album(data['album_id'])
-        release_from_beets(rpq, release, source, beetz_release)
-
-    tracklist = release_dict.get(release, [])
-    tracklist.append((data['track'], track))
-    release_dict[release] = tracklist
-
-    ## Add the tracklist if it's full
-    if len(release_dict[release]) == data['tracktotal']:
-        # add tracklist to release
-        # vv maybe get rid of this line? vv
-        tracklist = release_dict[release]
-        tracklist.sort()
-        for idx, (track_num, track) in enumerate(tracklist):
-            if idx + 1 != track_num:
-                log.warning(f"Tracklist Misaligned\nTrack {idx + 1}"
-                            f" has track num {track_num}: {track}")
-        # extract list of only second value in list of tuples
-        sorted_tracks = list(tuple(zip(*tracklist))[1])
-        tlist_node = TrackList(rpq, sorted_tracks)
-        rpq.rassert(
-            f"rdf_assert('{release}', '{XCAT.tracklist}', '{tlist_node}')"
-        )
-        del release_dict[release]
+    release_triples = None
+    if album:
+        release_triples = TripleList()
+        release_from_beets(release_triples, release, source, album)
+
+    return BuiltTrack(file_URN, track, data['disc'], data['track'],
+                      data['album_id'], release, triples, release_triples)
 
-    rpq.rassert(f"rdf_assert('{track}', '{XCAT.released_on}', '{release}')")
 
-    return file_URN
+def write_track(rpq, triples, labels, built):
+    """Resolve the terms of a BuiltTrack and add its triples to the loader,
+    along with its release if it's new."""
+    write_triples(rpq, triples, labels, built.triples)
+
+    ## Add the release
+    release = built.release
+    if release not in loaded_releases and built.release_triples is not None:
+        if not rpq.boolquery(
+                f"rdf('{release}', '{RDF.type}', '{XCAT.Release}')"):
+            write_triples(rpq, triples, labels, built.release_triples)
+        loaded_releases.add(release)
+
+    ## Keep the track for the tracklist, which build_tracklists adds
+    album_id, tracks = release_dict.setdefault(release, (built.album_id, []))
+    tracks.append((built.disc or 0, built.track_num or 0, built.track))
+
+    return built.file_uri
+
+
+def write_triples(rpq, triples, labels, built_triples):
+    """Add built triples to the loader, resolving their Labelled and Date
+    terms, and index the labels of the resources they name."""
+    types = {}
+    for triple in built_triples:
+        subj, pred, obj = (resolve(rpq, triples, labels, term)
+                           for term in triple)
+        if pred == RDF.type:
+            types[subj] = obj
+        elif pred == XCAT.name and subj in types:
+            labels.add(types[subj], obj, subj)
+        triples.add(subj, pred, obj)
+
+
+def resolve(rpq, triples, labels, term):
+    """URI of a Labelled or Date term, any other term as is."""
+    if isinstance(term, Labelled):
+        if (uri := labels.get(*term)) is None:
+            uri = labels.add(*term, rpq.new_bnode())
+        return uri
+    if isinstance(term, Date):
+        return LDateTime(rpq, triples, **dict(term.fields))
+    return term
 
 # f"rdf_assert('{}', '{}', '{}')"
-def add_genres(rpq, subj, beets_dict):
+def add_genres(triples, subj, beets_dict):
     genres, styles, unmatched = discogs.genre_styles(get_genre_vals(beets_dict),
                                                      get_style_vals(beets_dict))
-    assertion_list = []
     for genre_name, genre_uri in genres:
-        genre_name = xsd_type(genre_name, 'string')
-        assertion_list += [
-            f"rdf_assert('{genre_uri}', '{RDF.type}', '{XCAT.Genre}')",
-            f"rdf_assert('{genre_uri}', '{XCAT.name}', {genre_name})",
-            f"rdf_assert('{subj}', '{XCAT.genre}', '{genre_uri}')"
-            ]
+        triples.add(genre_uri, RDF.type, XCAT.Genre)
+        triples.add(genre_uri, XCAT.name, xsd_type(genre_name, 'string'))
+        triples.add(subj, XCAT.genre, genre_uri)
     for (style_name, style_uri), (genre_name, genre_uri) in styles:
-        genre_name = xsd_type(genre_name, 'string')
-        style_name = xsd_type(style_name, 'string')
-        assertion_list += [
-            f"rdf_assert('{style_uri}', '{RDF.type}', '{XCAT.Style}')",
-            f"rdf_assert('{style_uri}', '{XCAT.name}', {style_name})",
-            f"rdf_assert('{subj}', '{XCAT.style}', '{style_uri}')",
-            f"rdf_assert('{style_uri}', '{XCAT.parent_genre}', '{genre_uri}')",
-            f"rdf_assert('{genre_uri}', '{XCAT.genre_style}', '{style_uri}')"
-            ]
-    if assertion_list:
-        rpq.rassert(*assertion_list)
+        triples.add(style_uri, RDF.type, XCAT.Style)
+        triples.add(style_uri, XCAT.name, xsd_type(style_name, 'string'))
+        triples.add(subj, XCAT.style, style_uri)
+        triples.add(style_uri, XCAT.parent_genre, genre_uri)
+        triples.add(genre_uri, XCAT.genre_style, style_uri)
     for unmatched_name in unmatched:
         style_name = xsd_type(unmatched_name, 'string')
-        style_uri = rpq.simple_query(
-                f"rdf(X, '{RDF.type}', '{XCAT.Style}')",
-                f"rdf(X, '{XCAT.name}', {style_name})") or rpq.new_bnode()
-        if isinstance(style_uri, list):
-            style_uri = rdf_unify(rpq, style_uri)
-        rpq.rassert(*[
-            f"rdf_assert('{style_uri}', '{RDF.type}', '{XCAT.Style}')",
-            f"rdf_assert('{style_uri}', '{XCAT.name}', {style_name})",
-            f"rdf_assert('{subj}', '{XCAT.style}', '{style_uri}')",
-        ])
+        style_uri = Labelled(XCAT.Style, style_name)
+        triples.add(style_uri, RDF.type, XCAT.Style)
+        triples.add(style_uri, XCAT.name, style_name)
+        triples.add(subj, XCAT.style, style_uri)
 
 
 def get_genre_vals(beets_dict):
@@ -273,6 +287,8 @@ def get_style_vals(beets_dict):
 
 
 def beets_find_track(lib, path):
+    if isinstance(lib, BeetsIndex):
+        return dict(lib.items.get(path, {}))
     results = lib.items(f'path:"{path}"')
     if (item := results[0] if len(results) else None):
         item = dict(item.items())
@@ -289,42 +305,271 @@ def beets_find_release(lib, item_id):
         return {}
 
 
-def beets_init(path):
+def beets_album_tracks(lib, album_id):
+    """(disc, track num) of every item of a beets album."""
+    if isinstance(lib, BeetsIndex):
+        return lib.album_tracks(album_id)
+    return [(item.disc or 0, item.track or 0)
+            for item in lib.items(f'album_id:{album_id}')]
+
+
+def beets_init(path, preload=False):
+    if preload:
+        return BeetsIndex(path)
     return Library(path)
 
 
-def rec_load_dir(base_path, lib=None):
-    """Search a file path recursively for files in the beets library"""
-    dirpaths = {}
-    for dirpath, subdirs, filenames in os.walk(base_path, onerror=print,
-                                                    topdown=False):
+class BeetsIndex:
+    """Items and albums of a beets library, with their flexible attributes,
+    read from its sqlite db once into {path: item} and {id: album} dicts.
+
+    Stands in for the beets Library in beets_find_track and get_album.
+    """
+    def __init__(self, path):
+        with closing(sqlite3.connect(path)) as db:
+            db.row_factory = sqlite3.Row
+            items = self._load(db, 'items', 'item_attributes')
+            self.albums = self._load(db, 'albums', 'album_attributes')
+        self.items = {}
+        for item in items.values():
+            item['path'] = item['path'].decode('utf-8')
+            self.items[item['path']] = item
+        # {album id: [(disc, track num)]}, grouped on first use
+        self._album_tracks = None
+
+
+    @staticmethod
+    def _load(db, table, attribute_table):
+        entities = {row['id']: dict(row)
+                    for row in db.execute(f"SELECT * FROM {table}")}
+        for entity_id, key, value in db.execute(
+                f"SELECT entity_id, key, value FROM {attribute_table}"):
+            if (entity := entities.get(entity_id)) is not None:
+                entity[key] = value
+        return entities
+
+
+    def get_album(self, album_id):
+        return self.albums.get(album_id)
+
+
+    def album_tracks(self, album_id):
+        if self._album_tracks is None:
+            self._album_tracks = {}
+            for item in self.items.values():
+                self._album_tracks.setdefault(item['album_id'], []).append(
+                    (item['disc'] or 0, item['track'] or 0))
+        return self._album_tracks.get(album_id, [])
+
+
+def rec_load_dir(base_path, lib=None, workers=8, cache=None, skip=None):
+    """Search a file path recursively for files in the beets library.
+
+    Yields (dirpath, (in_db, not_in_db, subdir_hashes, dir_hash)) bottom-up,
+    leaving out the directories for which skip(dirpath, dir_hash) is true.
+    """
+    # hashes of the directories whose parent wasn't reached yet
+    dir_hashes = {}
+    for dirpath, subdirs, filenames, file_hashes in hash_tree(
+            base_path, workers, cache=cache):
         in_db = {}
         not_in_db = {}
         subdir_hashes = []
-        entry_hashes = []
         for subdir in subdirs:
             subdir_path = os.path.join(dirpath, subdir)
             # check if subdir is empty before crashing maybe
-            if not (subdir_dirpath := dirpaths.get(subdir_path)):
+            if not (subdir_hash := dir_hashes.pop(subdir_path, None)):
                 raise Exception(f"{subdir_path}\n not encountered"
                                 f"before\n{dirpath}")
-            subdir_hashes += [subdir_dirpath[3]]
-
-        for filename in filenames:
+            subdir_hashes += [subdir_hash]
+        if not (file_hashes or subdir_hashes):
+            continue
+        dir_hash = dir_hashes[dirpath] = hashlist_hash(file_hashes
+                                                       + subdir_hashes)
+        if skip and skip(dirpath, dir_hash):
+            continue
+
+        for filename, _hash in zip(filenames, file_hashes):
             fullpath = os.path.join(dirpath, filename)
             _mtime = os.stat(fullpath).st_mtime
-            _hash = file_hash(fullpath, interactive=True)
-            entry_hashes += [_hash]
             if lib and (filedata := beets_find_track(lib, fullpath)):
                 in_db[filename] = dict(_hash=_hash, _mtime=_mtime, **filedata)
             else:# 'path' matches respective key name from beets
                 not_in_db[filename] = dict(_hash=_hash, _mtime=_mtime,
                                            path=fullpath)
-        if entry_hashes or subdir_hashes:
-            dir_hash = hashlist_hash(entry_hashes + subdir_hashes)
-            dirpaths[dirpath] = (in_db, not_in_db, subdir_hashes, dir_hash)
-
-    return dirpaths
+        yield dirpath, (in_db, not_in_db, subdir_hashes, dir_hash)
+
+
+def build_tracklists(rpq, release_dict, beets_lib, releases=None):
+    """Assert the tracklists of the releases in release_dict, all in one
+    transaction, and remove them from it.
+
+    Tracks are ordered by disc and track number, and checked against the
+    items beets has for the album. Releases with tracks missing or sharing
+    a position are left in release_dict for a later import to complete.
+    releases limits this to some of the releases in release_dict.
+
+    Returns {release: (anomaly, details)} of every release that looked off,
+    whether its tracklist was asserted or not.
+    """
+    anomalies = {}
+    statements = []
+    for release in list(release_dict if releases is None else releases):
+        if release not in release_dict:
+            continue
+        album_id, tracks = release_dict[release]
+        if rpq.boolquery(
+                f"rdf({escape_string(release)}, '{XCAT.tracklist}', _)"):
+            # asserted before an interrupted import could journal it
+            anomalies[release] = ('tracklist exists', tracks)
+            del release_dict[release]
+            continue
+        tracks = sorted(set(tracks))
+        positions = [(disc, track_num) for disc, track_num, _ in tracks]
+        expected = beets_album_tracks(beets_lib, album_id) if album_id else []
+        if not expected:
+            anomalies[release] = ('no beets album', album_id)
+            continue
+        if (missing := sorted(set(expected) - set(positions))):
+            anomalies[release] = ('partial', missing)
+            continue
+        if len(set(positions)) < len(positions):
+            anomalies[release] = ('shared positions', [
+                track for track in tracks
+                if positions.count(track[:2]) > 1])
+            continue
+
+        # asserted, but worth a look
+        discs = {}
+        for disc, track_num in positions:
+            discs.setdefault(disc, []).append(track_num)
+        if (extra := sorted(set(positions) - set(expected))):
+            anomalies[release] = ('not in beets', extra)
+        elif any(track_nums != list(range(1, len(track_nums) + 1))
+                 for track_nums in discs.values()):
+            anomalies[release] = ('misnumbered', positions)
+
+        seq = f"_Seq{len(statements)}"
+        track_list = ', '.join(escape_string(track) for *_, track in tracks)
+        statements.append(
+            f"rdf_assert_seq({seq}, [{track_list}]), "
+            f"rdf_retractall({seq}, '{RDF.type}', '{RDF.Seq}'), "
+            f"rdf_assert({seq}, '{RDF.type}', '{XCAT.TrackList}'), "
+            f"rdf_assert({escape_string(release)}, '{XCAT.tracklist}', {seq})")
+        del release_dict[release]
+    if statements:
+        rpq.rassert(*statements)
+    return anomalies
+
+
+def import_dirs(rpq, triples, labels, journal, dirs, beets_lib, processes=0,
+                checkpoint=50):
+    """Add the directories from rec_load_dir to the store.
+
+    The triples of the tracks are built on a pool of processes, and written
+    in order here, so this stays the only process using the store. Up to
+    twice as many directories as processes are built ahead of the writer.
+
+    At every checkpoint, the tracklists of the releases beets has all the
+    tracks of are asserted, so only the incomplete ones are kept around.
+    Returns the anomalies of those tracklists, as from build_tracklists.
+    """
+    # spawned, not forked from a process with prolog and threads running
+    pool = ProcessPoolExecutor(processes, mp_context=get_context('spawn')
+                               ) if processes else None
+    albums = set() # album ids whose release triples were built
+    pending = deque()
+    anomalies = {}
+
+    def write(dirpath, dir_hash, not_in_db, futures):
+        dir_entries = []
+        for future in futures:
+            built = future.result()
+            dir_entries.append(write_track(rpq, triples, labels, built))
+            journal.releases.add(built.release)
+        dir_entries += [nometa_file_node(rpq, entry, triples)
+                        for entry in not_in_db.values()]
+        entries_to_dir(rpq, dir_hash, dirpath, dir_entries, triples)
+        journal.pending.append((dirpath, dir_hash))
+        if len(journal.pending) >= checkpoint:
+            triples.flush()
+            # the rest of the incomplete ones are looked at again at the end
+            anomalies.update(
+                (release, anomaly) for release, anomaly in build_tracklists(
+                    rpq, release_dict, beets_lib, journal.releases).items()
+                if release not in release_dict)
+            journal.checkpoint(release_dict)
+
+    try:
+        for dirpath, (in_db, not_in_db, subdir_hashes, dir_hash) in dirs:
+            futures = []
+            for entry in in_db.values():
+                album = None
+                if (album_id := entry['album_id']) and album_id not in albums:
+                    albums.add(album_id)
+                    album = beets_find_release(beets_lib, album_id)
+                if pool:
+                    future = pool.submit(track_from_beets, entry, album)
+                else:
+                    future = Future()
+                    future.set_result(track_from_beets(entry, album))
+                futures.append(future)
+            pending.append((dirpath, dir_hash, not_in_db, futures))
+            while pending and (len(pending) > 2 * processes or all(
+                    future.done() for future in pending[0][3])):
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    return anomalies
+
+
+class ImportJournal:
+    """Checkpoints of an import: the directories whose triples are committed
+    to the store, and the tracklists still missing tracks at that point."""
+    def __init__(self, filename, rpq, restart=False):
+        self.rpq = rpq
+        self.db = SqliteDict(filename, tablename='import_journal',
+                             flag='w' if restart else 'c')
+        # directories imported since the last checkpoint
+        self.pending = []
+        # releases whose tracks changed since the last checkpoint
+        self.releases = set()
+
+
+    def done(self, dirpath, dir_hash):
+        """Whether the directory was imported, and is still in the store
+        (which clean_db.sh may have wiped since)."""
+        return (self.db.get(f"dir:{dirpath}") == dir_hash
+                and self.rpq.boolquery(
+                    f"rdf('{B3[dir_hash]}', '{XCAT.path}', "
+                    f"{xsd_type(dirpath, 'string')})"))
+
+
+    def tracklists(self):
+        return {key[len('release:'):]: value for key, value in self.db.items()
+                if key.startswith('release:')}
+
+
+    def checkpoint(self, release_dict):
+        """Record the pending directories, once their triples are flushed,
+        and the changed releases as they are in release_dict."""
+        for dirpath, dir_hash in self.pending:
+            self.db[f"dir:{dirpath}"] = dir_hash
+        for release in self.releases:
+            if release in release_dict:
+                self.db[f"release:{release}"] = release_dict[release]
+            elif f"release:{release}" in self.db:
+                del self.db[f"release:{release}"]
+        self.db.commit()
+        self.releases = set()
+        self.pending = []
+
+
+    def close(self):
+        self.db.close()
 
 
 if __name__ == "__main__":
@@ -334,14 +579,26 @@ if __name__ == "__main__":
     parser.add_argument('input', help='folder(s) to scan', nargs="+")
     parser.add_argument('--beets-library', '-b',
                         help='beets sqlite db to reference')
-    parser.add_argument('--pickle-cache', '-p', action='store_true',
-                        help='use a cache of the filedata from the last run')
+    parser.add_argument('--preload-beets', '-P', action='store_true',
+                        help='read the whole beets library into memory '
+                        'up front instead of querying it for every file')
+    parser.add_argument('--restart', action='store_true',
+                        help='discard the checkpoints of earlier runs and '
+                        'import every directory')
+    parser.add_argument('--checkpoint', '-c', type=int, default=50,
+                        help='directories to import between checkpoints')
+    parser.add_argument('--workers', '-j', type=int, default=8,
+                        help='number of files to hash in parallel')
+    parser.add_argument('--processes', '-J', type=int, default=os.cpu_count(),
+                        help='number of processes building triples, 0 '
+                        'builds them in the process writing to the store')
+    parser.add_argument('--rehash', action='store_true',
+                        help='hash every file, even if its hash is cached')
     args = parser.parse_args()
     data_location = '../data/'
     beets_path = args.beets_library or os.path.join(data_location,
                                                     'ext/music.db')
-    beets_lib = beets_init(beets_path)
-    cache_file = os.path.join(data_location, 'cache/loaded_dir.pickle')
+    journal_file = os.path.join(data_location, 'cache/import_journal.sqlite')
 
     log = logging.getLogger('beets_to_rdf')
     log.setLevel(logging.DEBUG)
@@ -351,41 +608,62 @@ if __name__ == "__main__":
     log.addHandler(log_handler)
 
     log.info(f"\n\t\tBeets to RDF {datetime.now()}")
+    start = time.perf_counter()
+    beets_lib = beets_init(beets_path, args.preload_beets)
+    if args.preload_beets:
+        log.info(f"preloaded {len(beets_lib.items)} items and "
+                 f"{len(beets_lib.albums)} albums from {beets_path}: "
+                 f"{time.perf_counter() - start:.1f}s")
     # initialize prolog store
     rpq = RPQ('init.pl', write_mode=True)#, log=log)
 
-    # load files from directory
-    if not args.pickle_cache:
-        cache = None
-    else:
-        try:
-            cache = pickle.load(open(cache_file, 'rb'))
-        except Exception as e:
-            cache = None
-            print(f'could not load cache {cache_file}\n{e}')
-    if cache:
-        dirpaths = cache
-    else:
-        dirpaths = {}
+    journal = ImportJournal(journal_file, rpq, args.restart)
+    if (tracklists := journal.tracklists()):
+        release_dict.update(tracklists)
+        log.info(f"resuming with {len(tracklists)} incomplete tracklists")
+
+    # artists and styles by name, so no track has to look them up
+    start = time.perf_counter()
+    labels = LabelIndex(rpq, [XCAT.Artist, XCAT.Style])
+    merged = labels.unify()
+    log.info(f"indexed {len(labels)} artist and style names, merged "
+             f"{merged} duplicates: {time.perf_counter() - start:.1f}s")
+
+    # walk, hash, look up and add music data from each directory to the
+    # prolog rdf store as they come
+    triples = TripleLoader(rpq)
+    anomalies = {}
+    start = time.perf_counter()
+    with HashCache() as hash_cache:
         for path in args.input:
             path = os.path.abspath(path)
-            dirpaths.update(rec_load_dir(path, beets_lib))
-
-    # cache directory data
-    pickle.dump(dirpaths, open(cache_file, 'wb+'))
-
-    # add music data from directory to prolog rdf store
-    for idx, (dir, (in_db, not_in_db, subdir_hashes, dir_hash)
-              ) in enumerate(dirpaths.items()):
-        dir_entries = []
-        #log.debug(f"{dir}: {len(in_db)} in beets, {len(not_in_db)} not in beets")
-        #if not idx % 10:
-        #    log.debug(f"importing directory {idx} of {len(dirpaths)}")
-        for entry in in_db.values():
-            dir_entries += [track_from_beets(rpq, beets_lib, entry)]
-        for entry in not_in_db.values():
-            dir_entries += [nometa_file_node(rpq, entry)]
-        entries_to_dir(rpq, dir_hash, dir, dir_entries)#, subdir_hashes)
-    log.warning("Incomplete tracklists:")
-    for release, item in release_dict.items():
-        log.warning(':\n'.join([str(release), pformat(item)]))
+            dirs = rec_load_dir(path, beets_lib, args.workers,
+                                None if args.rehash else hash_cache,
+                                skip=journal.done)
+            anomalies.update(import_dirs(rpq, triples, labels, journal, dirs,
+                                         beets_lib, args.processes,
+                                         args.checkpoint))
+        log.info(f"hash cache: {hash_cache.hits} hits, "
+                 f"{hash_cache.misses} misses")
+    triples.flush()
+    elapsed = time.perf_counter() - start
+    log.info(f"asserted {triples.count} triples in {elapsed:.1f}s: "
+             f"{triples.count / elapsed:.0f} triples/s overall, "
+             f"{triples.rate():.0f} triples/s asserting")
+
+    # the tracklists left incomplete at the checkpoints, with every track in
+    start = time.perf_counter()
+    releases = set(release_dict)
+    anomalies.update(build_tracklists(rpq, release_dict, beets_lib))
+    journal.releases |= releases - set(release_dict)
+    journal.checkpoint(release_dict)
+    journal.close()
+    log.info(f"added {len(releases) - len(release_dict)} of {len(releases)} "
+             f"remaining tracklists: {time.perf_counter() - start:.1f}s")
+    if anomalies:
+        kinds = {}
+        for release, (anomaly, details) in anomalies.items():
+            kinds[anomaly] = kinds.get(anomaly, 0) + 1
+            log.debug(f"{anomaly}: {release}\n{pformat(details)}")
+        log.warning("Tracklist anomalies: " + ", ".join(
+            f"{count} {anomaly}" for anomaly, count in kinds.items()))
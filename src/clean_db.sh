@@ -1,3 +1,4 @@
 #!/usr/bin/sh
 
 rm -r ../data/pl_store/*
+rm -f ../data/cache/import_journal.sqlite
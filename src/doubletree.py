@@ -69,6 +69,9 @@ class InstanceView(ur.Pile):
         self.i_class = None
         self.rpquery = None
         self.searching = False
+        # whether the search text matched, among the nodes indexed so far
+        self.matched = False
+        self.indexing = False
         super().__init__([("pack", self.views), self.tree])
 
     def keypress(self, size, key):
@@ -101,13 +104,33 @@ class InstanceView(ur.Pile):
     def start_search(self):
         self.searching = True
         self.search_bar = ur.Edit("/")
+        ur.connect_signal(self.search_bar, 'change', self.incremental_search)
         self.contents.append((self.search_bar, ur.Pile.options("pack")))
         self.focus_position = len(self.contents) - 1
 
+    def incremental_search(self, search_bar, search_text):
+        self.matched = self.tree.body.match_select(search_text)
+
     def try_search(self):
-        self.tree.body.match_select(self.search_bar.edit_text)
+        self.tree.body.match_select(self.search_bar.edit_text, next_match=True)
         self.focus_position -= 1
 
+    def index_tree(self, main_loop, *args):
+        """Index the tree on show for searching a chunk at a time, between
+        screen updates, while searching.
+
+        The search is tried again with every chunk until it has a match.
+        """
+        if not self.searching:
+            self.indexing = False
+            return
+        self.indexing = not self.tree.body.build_index()
+        if not self.matched:
+            self.matched = self.tree.body.match_select(
+                self.search_bar.edit_text)
+        if self.indexing:
+            main_loop.set_alarm_in(0, self.index_tree)
+
     def end_search(self):
         self.tree.body.match_select(self.search_bar.edit_text)
         self.searching = False
@@ -119,6 +142,9 @@ class InstanceView(ur.Pile):
             return
         if parent:
             self.parent = parent
+        if self.rpquery is not None:
+            # free the rows of the pages the old view didn't get to
+            self.rpquery.close()
         self.rpquery = query.copy(self.parent)
         if self.rpquery:
             log.debug(str(self.rpquery))
@@ -135,7 +161,7 @@ class InstanceView(ur.Pile):
 
     def load_view(self, sel_class=None):
         view_query = self.window.rpq.querylist(
-                tree_views[self.views.selected()])
+                tree_views[self.views.selected()], prefetch=True)
         self.new_tree(sel_class, view_query)
 
 
@@ -311,6 +337,9 @@ class Window(ur.Frame):
 
     def update_dynamic(self, main_loop, *args):
         self.frames["OPERATE"].reload_screen()
+        if (self.frames["BROWSE"].searching
+                and not self.frames["BROWSE"].indexing):
+            self.frames["BROWSE"].index_tree(main_loop)
         main_loop.set_alarm_in(self.update_rate, self.update_dynamic)
 
 
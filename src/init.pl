@@ -63,6 +63,36 @@ xcat_apply_recording_path(Recording, Filepath, Encoding) :-
     rdf_assert(File, xcat:recording, Recording),
     rdf_assert(Recording, xcat:file, File).
 
+% Keep the Row of every solution of Goal in the global variable Cursor,
+% sorted by the string Format makes of Values, unless Format is false.
+% Unbound values print as ".", as in the formatted results. Count is the
+% number of rows.
+rpq_open_cursor(Cursor, Format-Values-Row, Goal, Count) :-
+    (   Format == false
+    ->  findall(Row, Goal, Rows)
+    ;   findall(Key-Row,
+                (   Goal,
+                    maplist(rpq_sort_value, Values, Args),
+                    format(string(Key), Format, Args)
+                ),
+                Pairs),
+        keysort(Pairs, Sorted),
+        pairs_values(Sorted, Rows)
+    ),
+    Term =.. [rows|Rows],
+    nb_setval(Cursor, Term),
+    functor(Term, _, Count).
+
+rpq_sort_value(Value, '.') :-
+    var(Value), !.
+rpq_sort_value(Value, Value).
+
+% Row of each of the rows From to To of Cursor, without copying the rest.
+rpq_cursor_rows(Cursor, From, To, Row) :-
+    nb_getval(Cursor, Term),
+    between(From, To, Idx),
+    arg(Idx, Term, Row).
+
 xcat_type(Resource, Class) :-
     Resource = _^^Class, !.
 xcat_type(Resource, Class) :-
@@ -111,3 +141,33 @@ xcat_merge_into(This, That) :-
 xcat_retract(Resource) :-
     rdf_retractall(Resource, _, _),
     rdf_retractall(_, _, Resource).
+
+% Path under the directory Old, moved to the directory New.
+xcat_moved_path(Old, New, Path, NewPath) :-
+    string_concat(Old, Rest, Path),
+    (   Rest == "" ; sub_string(Rest, 0, 1, _, "/") ), !,
+    string_concat(New, Rest, NewPath).
+
+% Rewrite every xcat:path under Old to be under New, reporting progress
+% every Step paths. Count is the number of paths moved, or that would
+% be if DryRun is true.
+xcat_move_paths(Old, New, DryRun, Step, Count) :-
+    findall(S-Path,
+            (   rdf(S, xcat:path, Path^^xsd:string),
+                xcat_moved_path(Old, New, Path, _)
+            ),
+            Moves),
+    length(Moves, Count),
+    format(user_error, "~D paths under ~w~n", [Count, Old]),
+    (   DryRun == true
+    ->  true
+    ;   forall(nth1(N, Moves, File-FilePath),
+               (   xcat_moved_path(Old, New, FilePath, NewPath),
+                   rdf_update(File, xcat:path, FilePath^^xsd:string,
+                              object(NewPath^^xsd:string)),
+                   (   N mod Step =:= 0
+                   ->  format(user_error, "~D/~D paths moved~n", [N, Count])
+                   ;   true
+                   )
+               ))
+    ).
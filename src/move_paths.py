@@ -1,15 +1,46 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import logging
 from sys import stdout
 from datetime import datetime
-from pprint import pformat
 
-from rdflib.namespace import RDF, RDFS, OWL, XSD
+from rdflib.namespace import XSD
+
+from util.log import LogFormatter
+from util.rdf.pl import RPQ, _utf8, escape_string
+from util.rdf.namespaces import XCAT
+
+log = logging.getLogger('move_paths')
+
+
+def move_paths(rpq, oldpath, newpath, dry_run=False, step=10000):
+    """Move every xcat:path under the directory oldpath to newpath with one
+    pass over the paths in the store, in a single transaction.
+
+    Prolog reports its progress every step paths. Returns the number of
+    paths moved, or that would be moved if dry_run.
+    """
+    goal = (f"xcat_move_paths({escape_string(oldpath)}, "
+            f"{escape_string(newpath)}, {str(dry_run).lower()}, {step}, "
+            "Count)")
+    if dry_run:
+        result, = rpq.uns_query(goal)
+    else:
+        result, = rpq.rassert(goal)
+    return result['Count']
+
+
+def sample_moves(rpq, oldpath, newpath, limit=5):
+    """(path, new path) of the first few paths move_paths would move."""
+    return [(_utf8(res['Path']), _utf8(res['NewPath'])) for res in
+            rpq.uns_query(
+                f"limit({limit}, ("
+                f"rdf(_, '{XCAT.path}', Path^^'{XSD.string}'), "
+                f"xcat_moved_path({escape_string(oldpath)}, "
+                f"{escape_string(newpath)}, Path, NewPath)))")]
 
-from util.rdf.pl import RPQ, _utf8, xsd_type, entries_to_dir, nometa_file_node
-from util.rdf.namespaces import B3, XCAT
 
 if __name__ == "__main__":
     import argparse
@@ -18,25 +49,32 @@ if __name__ == "__main__":
                         help='old common root directory')
     parser.add_argument('newpath',
                         help='new common root directory')
+    parser.add_argument('--log', '-l', type=int, default=20, help=
+                        'output logging level (0-50), 0 prints all output')
+    parser.add_argument('--dry-run', '-d', action='store_true',
+                        help='count the paths to move without moving them')
+    parser.add_argument('--progress', '-p', type=int, default=10000,
+                        help='paths to move between progress reports')
     args = parser.parse_args()
 
-    rpq = RPQ('init.pl', write_mode=True)
-    print("loaded rdf db")
-
-    file_uris = rpq.uns_query(
-        #f"rdfs_individual_of(File_URI, '{XCAT.DirEntry}'), "
-        f"rdf(_, '{XCAT.path}', Path^^'{XSD.string}')"
-    )
-    assertions = []
-    for res in file_uris:
-        filepath = _utf8(res['Path'])
-        if args.oldpath in filepath:
-            newpath = filepath.replace(args.oldpath, args.newpath)
-            assertions.append(
-                f"rdf_update(_, _, {xsd_type(filepath, 'string')}, "
-                f"object({xsd_type(newpath, 'string')}))"
-            )
-        else:
-            print(filepath, "does not contain", args.oldpath)
-
-    rpq.rassert(*assertions)
+    log.setLevel(args.log)
+    log_handler = logging.StreamHandler(stdout)
+    log_handler.setLevel(args.log)
+    log_handler.setFormatter(LogFormatter())
+    log.addHandler(log_handler)
+    log.info(f"\n\t\tRDF Path Mover {datetime.now()}")
+
+    oldpath = os.path.abspath(args.oldpath)
+    newpath = os.path.abspath(args.newpath)
+    rpq = RPQ('init.pl', write_mode=not args.dry_run)
+    log.info("loaded rdf db")
+
+    if args.dry_run:
+        for path, moved_path in sample_moves(rpq, oldpath, newpath):
+            log.info(f"{path}\n\t-> {moved_path}")
+
+    start = time.perf_counter()
+    count = move_paths(rpq, oldpath, newpath, args.dry_run, args.progress)
+    log.info(f"{count} paths {'would be' if args.dry_run else 'were'} moved "
+             f"from {oldpath} to {newpath}: "
+             f"{time.perf_counter() - start:.1f}s")
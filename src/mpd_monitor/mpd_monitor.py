@@ -6,7 +6,7 @@ from datetime import datetime
 import musicpd
 from pyswip.prolog import Prolog
 
-from util.rdf.pl import RPQ, LDateTime, xsd_type
+from util.rdf.pl import RPQ, LDateTime, TripleLoader, xsd_type
 from util.rdf.namespaces import XCAT
 
 def mpd_monitor(client, client_kwargs):
@@ -29,10 +29,15 @@ def mpd_monitor(client, client_kwargs):
 
 def save_play(playing):
     ts = datetime.now()
-    now = LDateTime(rpq, year=ts.year, month=ts.month, day=ts.day, hour=ts.hour,
-                    minute=ts.minute)
-    rpq.rassert(f"rdf(File, '{XCAT.path}', {xsd_type(playing, 'string')})",
-                f"rdf_assert(File, '{XCAT.accessed_during}', '{now}')")
+    # a new date is asserted along with the play
+    triples = TripleLoader(rpq, batch_size=float('inf'))
+    now = LDateTime(rpq, triples, year=ts.year, month=ts.month, day=ts.day,
+                    hour=ts.hour, minute=ts.minute)
+    if rpq.rassert(triples.goal(),
+                   f"rdf(File, '{XCAT.path}', {xsd_type(playing, 'string')})",
+                   f"rdf_assert(File, '{XCAT.accessed_during}', '{now}')"):
+        # only now is the date in the store
+        triples.asserted()
 
 
 if __name__ == "__main__":
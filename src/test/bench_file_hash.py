@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""MB/s of b3.file_hash for small, medium and huge files.
+
+Compares 64KiB reads on one thread (the old file_hash) to the memory mapped,
+multithreaded path for files over the mmap threshold.
+
+run from src/: python -m test.bench_file_hash
+"""
+
+import os
+import time
+import tempfile
+
+from util.rdf.b3 import file_hash
+
+SIZES = {'small': (256 * 2**10, 200), 'medium': (32 * 2**20, 8),
+         'huge': (1024 * 2**20, 1)}
+
+
+def make_files(directory, size, count):
+    paths = []
+    for idx in range(count):
+        path = os.path.join(directory, f"{size}_{idx}")
+        with open(path, 'wb') as f:
+            for _ in range(0, size, 2**20):
+                f.write(os.urandom(min(2**20, size)))
+        paths.append(path)
+    return paths
+
+
+def rate(paths, size, **kwargs):
+    start = time.perf_counter()
+    hashes = [file_hash(path, **kwargs) for path in paths]
+    return hashes, len(paths) * size / 2**20 / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', '-d', help='directory for the test files '
+                        '(defaults to a temporary directory)')
+    parser.add_argument('--huge', type=int, default=1024,
+                        help='size of the huge file in MiB')
+    args = parser.parse_args()
+    SIZES['huge'] = (args.huge * 2**20, 1)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for name, (size, count) in SIZES.items():
+            paths = make_files(directory, size, count)
+            # read once so both runs hash from the page cache
+            rate(paths, size)
+            old_hashes, old_rate = rate(paths, size, max_threads=1,
+                                        mmap_threshold=float('inf'))
+            new_hashes, new_rate = rate(paths, size)
+            assert old_hashes == new_hashes
+            print(f"{name:<6} {count:>3} x {size // 2**10:>7}KiB: "
+                  f"{old_rate:8.1f} MB/s chunked, {new_rate:8.1f} MB/s now")
+            for path in paths:
+                os.remove(path)
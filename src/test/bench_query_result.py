@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Memory and time to format synthetic rows into QueryResults.
+
+run from src/: python -m test.bench_query_result
+"""
+
+import time
+import tracemalloc
+
+from util.rdf.pl import VarList
+
+
+def synthetic_rows(count):
+    return [{
+        "URI": f"http://example.org/resource/{idx}",
+        "InstanceClass": "http://www.w3.org/2000/01/rdf-schema#Resource",
+        "Class": "Recording",
+        "Label": f"track number {idx}",
+        "RPQ_KeyType": "http://xeroxc.at/schema#Recording",
+    } for idx in range(count)]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.rows)
+    q_as = VarList('[{Class}] {Label} <{URI}>')
+    tracemalloc.start()
+    start = time.perf_counter()
+    results = [q_as.result(**row) for row in rows]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{args.rows} rows: {size / 2**20:.1f} MiB, {elapsed:.3f}s")
+    print(results[0], results[0].type, results[0]["Label"],
+          results[0].get("InstanceClass"))
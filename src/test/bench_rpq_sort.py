@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Time RPQuery result ordering over synthetic rows (no prolog queries).
+
+run from src/: python -m test.bench_rpq_sort
+"""
+
+import random
+import time
+
+from indexed import IndexedOrderedDict
+
+from util.rdf.pl import RPQuery, VarList
+
+
+def old_add_results(query, results):
+    """Ordering as done before sort keys were precomputed."""
+    query._results = IndexedOrderedDict()
+    q_as = VarList(query.q_as)
+    q_by = VarList(query.q_by) if query.q_by else q_as
+    for key in sorted(results, key=lambda k: q_by.result(**results[k])):
+        query._results[key] = q_as.result(**results[key])
+
+
+def new_add_results(query, results):
+    query._results = IndexedOrderedDict()
+    query._add_results(results)
+
+
+def synthetic_rows(count):
+    words = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot"]
+    return {
+        f"http://example.org/{idx}": {
+            "Class": random.choice(words),
+            "Label": " ".join(random.choices(words, k=3)),
+            "MInt": str(random.randint(1, 12)),
+            "URI": f"http://example.org/{idx}",
+        } for idx in range(count)
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', type=int, default=100000)
+    args = parser.parse_args()
+
+    results = synthetic_rows(args.rows)
+    cases = [
+        ("q_as order", dict(q_as="[{Class}] {Label} <{URI}>")),
+        ("q_by order", dict(q_as="{Label}", q_by="{MInt}")),
+        ("natural order", dict(q_as="{Label}", q_by="{MInt}", natural=True)),
+    ]
+    for name, kwargs in cases:
+        query = RPQuery(None, "URI", "", **kwargs)
+        for func in (old_add_results, new_add_results):
+            if func is old_add_results and query.natural:
+                continue
+            start = time.perf_counter()
+            func(query, results)
+            elapsed = time.perf_counter() - start
+            print(f"{name:14} {func.__name__:16} {args.rows} rows: "
+                  f"{elapsed:.3f}s")
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Scroll a synthetic instance_list tree from top to bottom.
+
+The query results are filled in directly, so no prolog store is needed.
+run from src/: python -m test.bench_tree_scroll
+"""
+
+import time
+
+from indexed import IndexedOrderedDict
+
+from util.rdf.pl import RPQ, RPQuery
+from util.rdf.queries import tree_views
+from widgets.rpq import RPQ_Node, SearchableTreeWalker
+
+
+def synthetic_view(count):
+    proto = tree_views['instance_list'][0]
+    query = RPQuery(None, proto.child, proto.q_from, proto.q_as, proto.parent,
+                    proto.q_where, **proto.kwargs)
+    query._results = IndexedOrderedDict()
+    query._add_results({
+        f"http://example.org/{idx}": {
+            "URI": f"http://example.org/{idx}",
+            "Class": "Recording",
+            "Label": f"track {idx}",
+        } for idx in range(count)
+    })
+    query.complete = True
+    return query
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', type=int, default=50000)
+    args = parser.parse_args()
+
+    query = synthetic_view(args.rows)
+    start = time.perf_counter()
+    walker = SearchableTreeWalker(RPQ_Node(query, query.keys()[0], None))
+    walked = 1
+    position = walker.get_focus()[1]
+    while (position := walker.get_next(position)[1]) is not None:
+        walked += 1
+    elapsed = time.perf_counter() - start
+    print(f"scrolled {walked} of {args.rows} rows: {elapsed:.3f}s")
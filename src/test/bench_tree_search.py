@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Build the search index of a synthetic instance_list and time searches.
+
+run from src/: python -m test.bench_tree_search
+"""
+
+import time
+
+from test.bench_tree_scroll import synthetic_view
+from widgets.rpq import RPQ_Node, SearchableTreeWalker
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', type=int, default=100000)
+    parser.add_argument('--search', '-s', default="track 99999")
+    args = parser.parse_args()
+
+    query = synthetic_view(args.rows)
+    walker = SearchableTreeWalker(RPQ_Node(query, query.keys()[0], None))
+    start = time.perf_counter()
+    steps = []
+    while True:
+        step = time.perf_counter()
+        indexed = walker.build_index()
+        steps.append(time.perf_counter() - step)
+        if indexed:
+            break
+    print(f"indexed {len(walker.index.paths)} rows: "
+          f"{time.perf_counter() - start:.3f}s, {len(steps)} steps, "
+          f"slowest {max(steps) * 1000:.2f}ms")
+    # type the search string one character at a time
+    for end in range(1, len(args.search) + 1):
+        start = time.perf_counter()
+        node = walker.find(args.search[:end])
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"/{args.search[:end]:<{len(args.search)}} {elapsed:6.2f}ms "
+              f"{node.get_value() if node else None}")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""MpdConnection against a fake MPD server on a unix socket.
+
+run from src/: python -m pytest test/test_mpd.py
+"""
+
+import os
+import socket
+import tempfile
+import threading
+
+import pytest
+
+from util.mpd import MpdConnection
+
+
+class FakeMpd:
+    """Answers every command with OK, and status with a stopped player."""
+    def __init__(self, path):
+        self.path = path
+        self.connections = [] # open ones
+        self.accepted = 0
+        self.commands = []
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.bind(path)
+        self.sock.listen()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return # closed
+            self.connections.append(conn)
+            self.accepted += 1
+            threading.Thread(target=self.handle, args=(conn,),
+                             daemon=True).start()
+
+
+    def handle(self, conn):
+        try:
+            conn.sendall(b"OK MPD 0.23.0\n")
+            for line in conn.makefile('rb'):
+                command = line.decode().strip()
+                self.commands.append(command)
+                if command == 'status':
+                    conn.sendall(b"state: stop\nOK\n")
+                else:
+                    conn.sendall(b"OK\n")
+        except OSError:
+            pass # dropped
+
+
+    def drop(self):
+        """Drop every client connection, as MPD does after its timeout."""
+        while self.connections:
+            conn = self.connections.pop()
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fake = FakeMpd(os.path.join(tmpdir, 'mpd.sock'))
+        yield fake
+        fake.drop()
+        fake.close()
+
+
+def test_reuses_connection(server):
+    client = MpdConnection(server.path)
+    assert client.status()['state'] == 'stop'
+    client.add('some/file.flac')
+    client.ping()
+    assert server.accepted == 1
+    assert server.commands == ['status', 'add "some/file.flac"', 'ping']
+
+
+def test_reconnects_after_drop(server):
+    client = MpdConnection(server.path)
+    client.ping()
+    server.drop()
+    assert client.status()['state'] == 'stop'
+    assert server.accepted == 2
+    assert server.commands[-1] == 'status'
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""RPAssert transactions against an in-memory rdf store.
+
+run from src/: python -m pytest test/test_rpassert.py
+"""
+
+from pyswip.prolog import Prolog
+
+from util.rdf.pl import RPQ, RPAssert
+
+prolog = Prolog()
+list(prolog.query("use_module(library('semweb/rdf11'))"))
+
+
+def stored(subj):
+    return list(prolog.query(f"rdf('{subj}', P, O)"))
+
+
+def test_commits_all_solutions():
+    res = RPAssert(prolog, "rdf_assert('s_commit', 'p', 'o1')",
+                   "rdf_assert('s_commit', 'p', 'o2')",
+                   "rdf_create_bnode(X)", write_mode=True).execute()
+    assert len(res) == 1 and 'X' in res[0]
+    assert len(stored('s_commit')) == 2
+
+
+def test_rolls_back_when_last_goal_fails():
+    res = RPAssert(prolog, "rdf_assert('s_fail', 'p', 'o1')",
+                   "rdf_assert('s_fail', 'p', 'o2')",
+                   "rdf('s_missing', _, _)", write_mode=True).execute()
+    assert res == []
+    assert stored('s_fail') == []
+
+
+def test_transaction_commits_every_assert():
+    rpq = RPQ(write_mode=True)
+    with rpq.transaction() as transaction:
+        assert rpq.rassert("rdf_assert('s_batch', 'p', 'o1')") is None
+        rpq.rassert("rdf_assert('s_batch', 'p', X)", "X = 'o2'")
+        # not asserted until the block ends
+        assert stored('s_batch') == []
+    assert transaction.committed
+    assert len(stored('s_batch')) == 2
+
+
+def test_transaction_rolls_back_earlier_asserts():
+    rpq = RPQ(write_mode=True)
+    with rpq.transaction() as transaction:
+        rpq.rassert("rdf_assert('s_batch_fail', 'p', 'o1')")
+        rpq.rassert("rdf_assert('s_batch_fail', 'p', 'o2')",
+                    "rdf('s_missing', _, _)")
+    assert not transaction.committed
+    assert stored('s_batch_fail') == []
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import logging
 import pickle
 from sys import stdout
@@ -10,14 +11,18 @@ from pprint import pformat
 from rdflib.namespace import RDF, RDFS, OWL, XSD
 
 from util.log import LogFormatter
-from util.rdf.b3 import file_hash, hashlist_hash
-from util.rdf.pl import RPQ, _utf8, xsd_type, entries_to_dir, nometa_file_node
+from util.rdf.b3 import HashCache, hash_tree, hashlist_hash
+from util.rdf.pl import (RPQ, TripleLoader, _utf8, xsd_type, escape_string,
+                         entries_to_dir, nometa_file_node)
 from util.rdf.namespaces import B3, XCAT
 
-def rec_file_hash(path):
+log = logging.getLogger('update_paths')
+
+def rec_file_hash(path, workers=8, cache=None):
     # path: hash (?)
     dirpaths = {}
-    for dirpath, subdirs, filenames in os.walk(path, topdown=False):
+    for dirpath, subdirs, filenames, file_hashes in hash_tree(path, workers,
+                                                              cache=cache):
         entry_hashes = []
         for subdir in subdirs:
             subdir_path = os.path.join(dirpath, subdir)
@@ -26,9 +31,8 @@ def rec_file_hash(path):
                                 f"before\n{dirpath}")
             entry_hashes.append(subdir_hash)
 
-        for filename in filenames:
+        for filename, filehash in zip(filenames, file_hashes):
             fullpath = os.path.join(dirpath, filename)
-            filehash = file_hash(fullpath, interactive=True)
             entry_hashes.append(filehash)
             dirpaths[fullpath] = filehash
 
@@ -39,20 +43,94 @@ def rec_file_hash(path):
 
 
 def child_entries(dirpaths, dirpath):
+    # empty directories have no hash, so they are left out
     if os.path.isdir(dirpath):
-        hashes = []
-        for entry in os.listdir(dirpath):
-            entry = os.path.join(dirpath, entry)
-            if entry not in dirpaths:
-                print(entry)
-                for path, phash in list(dirpaths.items())[:10]:
-                    print(phash, path)
-                raise Exception("Something wrong w/ bottom-up assumptions?")
-            hashes.append(dirpaths[entry])
-        if hashes:
-            return hashes
+        return [dirpaths[entry] for entry in
+                (os.path.join(dirpath, name) for name in os.listdir(dirpath))
+                if entry in dirpaths]
+
+
+def reconcile(rpq, dirpaths, dry_run=False, timings=None):
+    """Apply the differences between {path: hash} dirpaths and the DirEntry
+    paths in the store in a single transaction.
+
+    Returns the number of added, moved and removed hashes.
+    """
+    timings = {} if timings is None else timings
+    # get dict of (dirhash: [paths]) for each hash
+    start = time.perf_counter()
+    dirhashes = {}
+    for path, pathhash in dirpaths.items():
+        pathlist = dirhashes.get(pathhash, [])
+        pathlist.append(path)
+        dirhashes[pathhash] = pathlist
+
+    # get dict of {hash: (uri, {paths})} for every entry in the pl store
+    stored = {}
+    for res in rpq.uns_query(
+            f"rdfs_individual_of(File_URI, '{XCAT.DirEntry}'), "
+            f"rdf(File_URI, '{XCAT.hash}', EntryHash^^'{XSD.string}'), "
+            f"rdf(File_URI, '{XCAT.path}', EntryPath^^'{XSD.string}')"):
+        file_uri, old_paths = stored.setdefault(
+            _utf8(res['EntryHash']), (_utf8(res['File_URI']), set()))
+        old_paths.add(_utf8(res['EntryPath']))
+    timings['fetch'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    added = dirhashes.keys() - stored.keys()
+    removed = stored.keys() - dirhashes.keys()
+    statements = []
+    moves = 0
+    for b3hash in dirhashes.keys() & stored.keys():
+        file_uri, old_paths = stored[b3hash]
+        new_paths = set(dirhashes[b3hash])
+        if old_paths == new_paths:
+            continue # nothing changed
+        moves += 1
+        log.debug(f"\n\told: {pformat(old_paths - new_paths, width=170)}"
+                  f"\n\tnew: {pformat(new_paths - old_paths, width=170)}")
+        statements += [f"rdf_retractall('{file_uri}', '{XCAT.path}', "
+                       f"{xsd_type(path, 'string')})"
+                       for path in old_paths - new_paths]
+        statements += [f"rdf_assert('{file_uri}', '{XCAT.path}', "
+                       f"{xsd_type(path, 'string')})"
+                       for path in new_paths - old_paths]
+
+    triples = TripleLoader(rpq, batch_size=float('inf'))
+    for b3hash in added:
+        paths = dirhashes[b3hash]
+        if len(paths) > 1:
+            log.debug(f"duplicate: {b3hash} (" + str(os.stat(paths[0]).st_size)
+                      + " bytes)\n" + pformat(paths, width=170))
+        log.debug(f"new direntry: {B3[b3hash]}\n{pformat(paths, width=160)}")
+        if (child_hashes := child_entries(dirpaths, paths[0])):
+            log.debug("it is a directory")
+            child_uris = [B3[child_hash] for child_hash in child_hashes]
+            for path in paths:
+                entries_to_dir(rpq, b3hash, path, child_uris, triples)
         else:
-            raise Exception("are empty directories handled upstream now?")
+            log.debug("it is a file")
+            for path in paths:
+                nometa_file_node(rpq, {'path': path, '_hash': b3hash}, triples)
+
+    removed_uris = []
+    for b3hash in removed:
+        file_uri, old_paths = stored[b3hash]
+        removed_uris.append(file_uri)
+        log.info(f"{file_uri} ({', '.join(old_paths)}) "
+                 f"{'would be' if dry_run else 'has been'} removed")
+    if removed_uris:
+        statements.append(f"maplist(xcat_retract, "
+                          f"[{', '.join(map(escape_string, removed_uris))}])")
+    timings['diff'] = time.perf_counter() - start
+
+    # apply everything in one transaction
+    start = time.perf_counter()
+    if (statements or triples.triples) and not dry_run:
+        rpq.rassert(*statements, triples.goal())
+    timings['apply'] = time.perf_counter() - start
+
+    return len(added), moves, len(removed)
 
 
 if __name__ == "__main__":
@@ -66,9 +144,14 @@ if __name__ == "__main__":
     parser.add_argument('--dry-run', '-d', action='store_true',
                         help='don\'t make any changes to the RDF store. '
                         '(can rewrite the cache file!)')
+    parser.add_argument('--workers', '-j', type=int, default=8,
+                        help='number of files to hash in parallel')
+    parser.add_argument('--rehash', action='store_true',
+                        help='hash every file, even if its hash is cached')
+    parser.add_argument('--stats', '-s', action='store_true',
+                        help='summarize the time taken by each phase')
     args = parser.parse_args()
 
-    log = logging.getLogger('update_paths')
     # why am i doing this twice?
     log.setLevel(args.log)
     log_handler = logging.StreamHandler(stdout)
@@ -78,87 +161,35 @@ if __name__ == "__main__":
     log.info(f"\n\t\tRDF Path Updater {datetime.now()}")
 
     # get dict of {path: dirhash} for each path in the tree(s)
+    timings = {}
+    start = time.perf_counter()
     cache_file = '../data/cache/updated_paths.pickle'
     if not args.pickle_cache:
         dirpaths = {}
-        for path in args.input:
-            path = os.path.abspath(path)
-            dirpaths.update(rec_file_hash(path))
+        with HashCache() as hash_cache:
+            for path in args.input:
+                path = os.path.abspath(path)
+                dirpaths.update(rec_file_hash(
+                    path, args.workers, None if args.rehash else hash_cache))
+            log.info(f"hash cache: {hash_cache.hits} hits, "
+                     f"{hash_cache.misses} misses")
     else:
         dirpaths = pickle.load(open(cache_file, 'rb'))
         log.info(f"loaded {cache_file}")
 
     pickle.dump(dirpaths, open(cache_file, 'wb+'))
 
-    rpq = RPQ('init.pl', write_mode=True)
+    timings['hash'] = time.perf_counter() - start
 
-    # get dict of (dirhash: [paths]) for each hash
-    dirhashes = {}
-    for path, pathhash in dirpaths.items():
-        pathlist = dirhashes.get(pathhash, [])
-        pathlist.append(path)
-        dirhashes[pathhash] = pathlist
+    start = time.perf_counter()
+    rpq = RPQ('init.pl', write_mode=True)
+    timings['load store'] = time.perf_counter() - start
 
-    for b3hash, paths in dirhashes.items():
-        assertions = []
-        if len(paths) > 1:
-            log.debug(f"duplicate: {b3hash} (" + str(os.stat(paths[0]).st_size)
-                      + " bytes)\n" + pformat(paths, width=170))
-        file_uri = B3[b3hash]
-        if (old_paths := rpq.uns_query(
-                f"rdf('{file_uri}', '{XCAT.path}', Path^^'{XSD.string}')"
-        )):
-            old_paths = [_utf8(res['Path']) for res in old_paths]
-            new_paths = []
-            for path in paths:
-                if path in old_paths:
-                    old_paths.remove(path) # nothing changed
-                else:
-                    new_paths.append(path) # new path
-            for path in old_paths:
-                assertions.append(f"rdf_retractall('{file_uri}', '{XCAT.path}'"
-                                  f", {xsd_type(path, 'string')})")
-            for path in new_paths:
-                assertions.append(f"rdf_assert('{file_uri}', '{XCAT.path}'"
-                                  f", {xsd_type(path, 'string')})")
-            if old_paths or new_paths:
-                log.debug(f"\n\told: {pformat(old_paths, width=170)}"
-                          f"\n\tnew: {pformat(new_paths, width=170)}")
-        else:
-            log.debug(f"new direntry: {file_uri}\n{pformat(paths, width=160)}")
-            if (child_hashes := child_entries(dirpaths, paths[0])):
-                child_uris = [B3[child_hash] for child_hash in child_hashes]
-                log.debug("it is a directory")
-                if not args.dry_run:
-                    [entries_to_dir(rpq, b3hash, path, child_uris)
-                     for path in paths]
-            else:
-                log.debug("it is a file")
-                if not args.dry_run:
-                    [nometa_file_node(rpq, {'path': path, '_hash': b3hash})
-                     for path in paths]
-
-        if assertions and not args.dry_run:
-            rpq.uns_query(", ".join(assertions))
-
-    # for uris in pl store if not in dirhashes: remove uri
-    file_uris = rpq.uns_query(
-        f"rdfs_individual_of(File_URI, '{XCAT.DirEntry}'), "
-        f"rdf(File_URI, '{XCAT.hash}', EntryHash^^'{XSD.string}'), "
-        f"rdf(File_URI, '{XCAT.path}', EntryPath^^'{XSD.string}')"
-    )
-    for res in file_uris:
-        file_hash = _utf8(res['EntryHash'])
-        file_uri = _utf8(res['File_URI'])
-        file_path = _utf8(res['EntryPath'])
-        if file_hash in dirhashes:
-            continue
-        else:
-            if args.dry_run:
-                log.info(f"\n\tremoved: {file_path}")
-            else:
-                rpq.uns_query(f"xcat_retract('{file_uri}')")
-                log.info(f"{file_uri} ({file_path}) has been removed")
+    added, moves, removed = reconcile(rpq, dirpaths, args.dry_run, timings)
+    log.info(f"{added} added, {moves} moved, {removed} removed")
+    if args.stats:
+        log.info(f"{len(dirpaths)} paths on disk\n" + "\n".join(
+            f"\t{phase}: {seconds:.2f}s" for phase, seconds in timings.items()))
 
 #            # for path in old_paths:
 #            #   if path in dirpaths and dirpaths[path]
@@ -1,16 +1,91 @@
 #!/usr/bin/env python3
 
+import time
+from functools import partial
+
 import musicpd
 
 import logging as log
 
+try:
+    from util.conf_file import Config
+except ImportError:
+    Config = None # no config file
+
+# the socket of the system MPD service, used unless the config file has an
+# mpd section
+MPD_SOCKET = '/run/mpd/socket'
+# seconds a connection can be idle before keep_alive pings MPD, well within
+# its default connection_timeout of 60
+KEEPALIVE = 30
+
+
+class MpdConnection:
+    """A persistent MPD connection, called like an MPDClient.
+
+    Connects on the first command, and reconnects and retries a command
+    once if the connection was lost. host is a socket path or a hostname,
+    port is only used with a hostname.
+    """
+    def __init__(self, host=MPD_SOCKET, port=None, keepalive=KEEPALIVE):
+        self.client = musicpd.MPDClient()
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.connected = False
+        self.last_used = 0.0
+
+
+    def __getattr__(self, command):
+        return partial(self.command, command)
+
+
+    def connect(self):
+        if not self.connected:
+            self.client.connect(self.host, self.port)
+            self.connected = True
+
+
+    def disconnect(self):
+        if self.connected:
+            self.connected = False
+            try:
+                self.client.disconnect()
+            except OSError:
+                # the socket is already broken, start over with a new client
+                self.client = musicpd.MPDClient()
+
+
+    def command(self, command, *args):
+        for retry in (False, True):
+            self.connect()
+            try:
+                result = getattr(self.client, command)(*args)
+            except (musicpd.ConnectionError, OSError) as e:
+                self.disconnect()
+                if retry:
+                    raise
+                log.warning(f"lost the MPD connection, reconnecting: {e}")
+                continue
+            self.last_used = time.monotonic()
+            return result
+
+
+    def keep_alive(self):
+        """Ping MPD if the connection has been idle for keepalive seconds."""
+        if (self.connected
+                and time.monotonic() - self.last_used > self.keepalive):
+            self.command('ping')
+
+
+# the connection shared by everything in the process
+client = MpdConnection(**(Config or {}).get('mpd', {}))
+
+
 def add_to_list(*filepaths, **filepath_dict):
     if (path := filepath_dict.get('Path')):
         filepaths += [path]
-    client = musicpd.MPDClient()
-    client.connect('/run/mpd/socket')
     for path in filepaths:
         #with open("whatsgoingon.txt", 'a') as f:
         #    f.write(f'{str(path)} {type(path)}\n')
         client.add(path)
-    client.disconnect()
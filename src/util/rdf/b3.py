@@ -1,38 +1,184 @@
 #!/usr/bin/env python3
 
 import os
+import mmap
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 from blake3 import blake3
+from sqlitedict import SqliteDict
 
 
-def file_hash(file_path, chunksize=65536, interactive=False):
+# files at least this large are memory mapped and hashed on max_threads
+MMAP_THRESHOLD = 16 * 2**20
+MMAP_CHUNKSIZE = 64 * 2**20
+# seconds between progress updates
+PROGRESS_INTERVAL = 0.5
+HASH_CACHE = '../data/cache/file_hashes.sqlite'
+
+
+def file_hash(file_path, chunksize=65536, interactive=False,
+              max_threads=blake3.AUTO, mmap_threshold=MMAP_THRESHOLD):
     """Return the hash of a given file, given its path"""
-    hasher = blake3()
-    chunk = 0
     with open(file_path, "rb") as f:
         try:
-            fullsize = os.path.getsize(file_path)
+            fullsize = os.fstat(f.fileno()).st_size
             if interactive and fullsize:
                 print(f'\thashing {file_path[-80:]} {fullsize//1024}KiB ',
                       end='\r')
-            while True:
-                some_bytes = f.read(chunksize)
-                chunk += 1
-                if interactive and fullsize:
-                    print(f'{int(((chunk*chunksize)/fullsize)*100)}% ',
-                          end='\r')
-                if not some_bytes:
-                    break
-                hasher.update(some_bytes)
+            if fullsize >= mmap_threshold:
+                hasher = blake3(max_threads=max_threads)
+                chunksize = max(chunksize, MMAP_CHUNKSIZE)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        chunks = (view[start:start + chunksize]
+                                  for start in range(0, fullsize, chunksize))
+                        _hash_chunks(hasher, chunks, fullsize, interactive)
+            else:
+                hasher = blake3()
+                chunks = iter(lambda: f.read(chunksize), b'')
+                _hash_chunks(hasher, chunks, fullsize, interactive)
             if interactive:
                 print(' ' * 120, end='\r')
         except KeyboardInterrupt:
             time.sleep(2)
             return None
-    print('\r\033[K', end="")
+    if interactive:
+        print('\r\033[K', end="")
     return hasher.hexdigest()
 
+
+def _hash_chunks(hasher, chunks, fullsize, interactive):
+    done = 0
+    last_print = time.monotonic()
+    for chunk in chunks:
+        hasher.update(chunk)
+        done += len(chunk)
+        if interactive and time.monotonic() - last_print > PROGRESS_INTERVAL:
+            last_print = time.monotonic()
+            print(f'{done * 100 // fullsize}% ', end='\r')
+
+
+class HashCache:
+    """Persistent {path: (size, mtime_ns, inode, hash)} of hashed files.
+
+    A cached hash is only used while the size, mtime and inode of the file
+    are unchanged.
+    """
+    def __init__(self, filename=HASH_CACHE, commit_every=1000):
+        self.db = SqliteDict(filename, tablename='file_hashes')
+        self.entries = dict(self.db.items())
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def get(self, path, stat):
+        entry = self.entries.get(path)
+        if entry and entry[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            self.hits += 1
+            return entry[3]
+        self.misses += 1
+
+
+    def put(self, path, stat, _hash):
+        entry = (stat.st_size, stat.st_mtime_ns, stat.st_ino, _hash)
+        self.entries[path] = self.db[path] = entry
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def hash_tree(base_path, workers=8, max_bytes=256 * 2**20, onerror=print,
+              cache=None):
+    """Hash the files under base_path on a pool of threads.
+
+    Yields (dirpath, subdirs, filenames, file hashes) bottom-up in os.walk
+    order, so every directory comes after its subdirectories, as directory
+    hashes from hashlist_hash need. No new file is queued while the files
+    queued but not yet waited for add up to more than max_bytes.
+
+    Files with a valid entry in the HashCache cache aren't read at all.
+    Files removed before they could be hashed are left out of filenames.
+    """
+    pending = deque()   # walk entries with the futures of their files
+    inflight = deque()  # (future, file size) in order of submission
+    inflight_bytes = 0
+    pool = ThreadPoolExecutor(workers)
+    try:
+        for dirpath, subdirs, filenames in os.walk(base_path, onerror=onerror,
+                                                   topdown=False):
+            futures = []
+            found = []
+            for filename in filenames:
+                fullpath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(fullpath)
+                except FileNotFoundError as e:
+                    onerror(e)
+                    continue
+                found.append(filename)
+                if cache and (_hash := cache.get(fullpath, stat)):
+                    future = Future()
+                    future.set_result(_hash)
+                    futures.append(future)
+                    continue
+                size = stat.st_size
+                while inflight and inflight_bytes + size > max_bytes:
+                    future, done_size = inflight.popleft()
+                    wait([future])
+                    inflight_bytes -= done_size
+                future = pool.submit(_cache_file_hash, fullpath, stat, cache)
+                inflight.append((future, size))
+                inflight_bytes += size
+                futures.append(future)
+            pending.append((dirpath, subdirs, found, futures))
+            while pending and all(future.done() for future in pending[0][3]):
+                yield _hashed_entry(*pending.popleft())
+        while pending:
+            yield _hashed_entry(*pending.popleft())
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _cache_file_hash(fullpath, stat, cache):
+    try:
+        _hash = file_hash(fullpath)
+    except FileNotFoundError:
+        return None
+    if _hash and cache:
+        cache.put(fullpath, stat, _hash)
+    return _hash
+
+
+def _hashed_entry(dirpath, subdirs, filenames, futures):
+    # files without a hash were removed (or hashing was interrupted)
+    hashed = [(filename, _hash) for filename, _hash in
+              zip(filenames, (future.result() for future in futures)) if _hash]
+    return (dirpath, subdirs, [filename for filename, _ in hashed],
+            [_hash for _, _hash in hashed])
+
+
 def hashlist_hash(hashlist):
     """Hash a list of hash hexdigests, return the hexdigest.
 
@@ -4,8 +4,13 @@ from typing import Optional, Union
 from frozendict import frozendict
 import logging as log
 import re
-from functools import total_ordering
-from collections import namedtuple
+import time
+import weakref
+from functools import partial, total_ordering
+from itertools import count
+from contextlib import contextmanager
+from operator import itemgetter
+from collections import namedtuple, OrderedDict
 from dataclasses import dataclass, replace
 
 from pyswip.prolog import Prolog
@@ -99,18 +104,64 @@ class ProtoQuery:
         self.kwargs = kwargs
 
 
+class QueryCache:
+    """Bounded LRU of RPQuery results, keyed by query and parent resource.
+
+    Any assertion (RPAssert.execute) invalidates the whole cache by bumping
+    its generation. Queries already holding results keep them.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+
+    def put(self, key, results):
+        self._entries[key] = results
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._entries), maxsize=self.maxsize,
+                    generation=self.generation)
+
+
 class RPQuery:
     """
     [WITH Parent EQUALS <RDF_Resource>::<RDF_Type>|<RDF_Resource>|::<RDF_Type>]
     SELECT Child[::<RDF_Type>|False] [AS <Format Expression>]
     FROM <Prolog Query> [BY <Format Expression>]
     [WHERE <Prolog Query>]
-    [RECURSIVE] [NULL] [UNIQUE]
+    [RECURSIVE] [NULL] [UNIQUE] [NATURAL] [PAGED <Page Size>]
                 [... <Descendant Queries>]
     """
+    # max number of children sent to a single WHERE goal
+    where_batch = 1000
+    # results shared between copies of a query
+    cache = QueryCache()
+    # numbers the prolog global variables holding the rows of paged queries
+    _cursors = count()
+    # cursors of queries garbage collected before they were read to the end,
+    # deleted by the next query opening a cursor
+    _stale_cursors = []
+
     def __init__(self, pl, child, q_from, q_as=None, parent=None, q_where=None,
                  q_by=None, unique=False, recursive=False, desc_q=None,
-                 null=False):
+                 null=False, page_size=None, natural=False, prefetch=False):
         if isinstance(parent, str):
             self.parent = ParentVar.parse(parent)
         else:
@@ -126,10 +177,22 @@ class RPQuery:
         self.unique = unique
         self.recursive = recursive
         self.null = null
+        self.natural = natural
         self.desc_q = desc_q
+        self.page_size = page_size
+        self.prefetch = prefetch
         self.pl = pl
+        self.complete = False
+        self._offset = 0
+        self._cursor = None
+        self._free_cursor = None
+        self._row_vars = None
+        self._row_count = 0
         self._results = None
         self._children = {}
+        self._positions = {}
+        self._from_goal = None
+        self._where_goal = None
 
     def copy(self, par_ref=None):
         parent = self.parent.copy()
@@ -137,92 +200,261 @@ class RPQuery:
             parent.resource = par_ref
         copy = RPQuery(self.pl, self.child, self.q_from, self.q_as, parent,
                        self.q_where, self.q_by, self.unique, self.recursive,
-                       self.desc_q, self.null)
+                       self.desc_q, self.null, self.page_size, self.natural,
+                       self.prefetch)
         return copy
 
     def _query(self):
         if self._results is not None:
             return self._results
-        # replace parent variable w/ its value
-        q_from, q_where = (None, None)
-        if self.parent:
-            if self.parent.resource:
-                p_value_str = self.parent.resource.replace("'", "\\'")
-                q_from = self.q_from.replace(self.parent.variable,
-                                            f"'{p_value_str}'")
-                if self.q_where:
-                    q_where = self.q_where.replace(self.parent.variable,
-                                                f"'{p_value_str}'")
-        else:
-            q_from = self.q_from
-            if self.q_where:
-                q_where = self.q_where
-
-        # add term querying type of the child
-        if self.child.rdf_type is not False:
-            type_expr = f", xcat_type({self.child.variable}, RPQ_KeyType)."
-            if isinstance(self.child.rdf_type, str):
-                type_expr = (", rdfs_subclass_of(RPQ_KeyType, "
-                             f"'{self.child.rdf_type}')" + type_expr)
-            if self.child.unpack_list and self.q_where:
-                q_where += type_expr
-            else:
-                q_from += type_expr
+        self._compile()
+        if (cached := self.cache.get(self._cache_key())) is not None:
+            self._results = cached
+            self.complete = True
+            return self._results
+        self._results = IndexedOrderedDict()
+        if self.paged:
+            self._open_cursor()
+            self.fetch_more()
+            return self._results
+        results, _ = self._fetch(self._from_goal.call(self._parent_value()))
+        self._add_results(results)
+        self.complete = True
+        self.cache.put(self._cache_key(), self._results)
+        return self._results
 
-        # retrieve q_from results
-        results = {}
+    @property
+    def paged(self):
+        """Whether results are formatted page_size rows at a time.
+
+        Every row is still solved and sorted at once, in prolog, so UNIQUE
+        and NATURAL queries, which need every formatted row, and queries
+        unpacking a list aren't paged.
+        """
+        return bool(self.page_size) and not (self.unique or self.natural
+                                             or self.child.unpack_list)
+
+    def _open_cursor(self):
+        """Solve FROM and WHERE for every row into a prolog global variable,
+        sorted by q_by (or q_as) formatted as a string, unless q_by is False.
+
+        fetch_more then reads the rows a page at a time by position, so no
+        prolog query is left open between pages and none is solved twice.
+        The rows are sorted like those of a query that isn't paged, except
+        when q_by (or q_as) is a function, whose variables are sorted on
+        formatted as "{} | {}" instead.
+        """
+        while self._stale_cursors:
+            list(self.pl.query(f"nb_delete({self._stale_cursors.pop()})"))
+        parent = self._parent_value()
+        goal = self._from_goal.call(parent)
+        if self.q_where:
+            where = f"once(({self._where_goal.call(None, parent)}))"
+            goal += f", ({where} -> true ; true)" if self.null else f", {where}"
+        self._row_vars = [var for var in _goal_vars(goal) if var[0] != '_']
+        if self.q_by is False:
+            sort_format, sort_vars = 'false', []
+        else:
+            q_by = VarList(self.q_by or self.q_as or self.child.variable)
+            sort_vars = q_by.var_list
+            if callable(q_by.print_str):
+                q_by = VarList(sort_vars)
+            # the str.format fields as format/2 directives
+            sort_format = escape_string(
+                q_by.print_str.replace('~', '~~').replace('{}', '~w'))
+        self._cursor = f"rpq_cursor_{next(self._cursors)}"
+        result, = self.pl.query(
+            f"rpq_open_cursor({self._cursor}, {sort_format}-"
+            f"[{', '.join(sort_vars)}]-[{', '.join(self._row_vars)}], "
+            f"({goal}), RPQ_Count)")
+        self._row_count = result['RPQ_Count']
+        self._free_cursor = weakref.finalize(
+            self, self._stale_cursors.append, self._cursor)
+        log.debug(f"{self._row_count} rows in {self._cursor}")
+
+    def close(self):
+        """Delete the rows of a paged query that wasn't read to the end, and
+        of its child queries, once it is no longer used."""
+        self._close_cursor()
+        for child in self._children.values():
+            if isinstance(child, RPQuery):
+                child.close()
+
+    def _close_cursor(self):
+        if self._free_cursor is not None and self._free_cursor.detach():
+            list(self.pl.query(f"nb_delete({self._cursor})"))
+
+    def fetch_more(self):
+        """Load the next page of a paged query. Return the number of new rows.
+        """
+        if self._results is None:
+            return len(self._query())
+        if self.complete:
+            return 0
+        added = 0
+        while not (added or self.complete):
+            end = min(self._offset + self.page_size, self._row_count)
+            rows = {}
+            for row in self.pl.query(
+                    f"rpq_cursor_rows({self._cursor}, {self._offset + 1}, "
+                    f"{end}, [{', '.join(self._row_vars)}])"):
+                rows[row[self.child.variable]] = {
+                    var: val for var, val in row.items()
+                    if not isinstance(val, easy.Variable)}
+            self._offset = end
+            if end == self._row_count:
+                self._close_cursor()
+                self.complete = True
+            loaded = len(self._results)
+            self._add_results(rows, ordered=True)
+            added = len(self._results) - loaded
+        if self.complete:
+            self.cache.put(self._cache_key(), self._results)
+        return added
+
+    def _parent_value(self):
+        if self.parent and self.parent.resource:
+            return escape_string(self.parent.resource)
+
+    def _fetch(self, q_from, parents=None):
+        """Query q_from (and q_where). Return {child: result vars} and the
+        number of q_from solutions.
+
+        If parents is given, q_from binds RPQ_Pdx to the index of the parent
+        in it for each solution, and results are {parent: {child: vars}}.
+        """
+        if parents is None:
+            results = {}
+        else:
+            results = {parent: {} for parent in parents}
+        solutions = 0
         log.debug(q_from)
         for from_result in self.pl.query(q_from):
+            solutions += 1
+            if parents is None:
+                rows = results
+            else:
+                rows = results[parents[from_result.pop('RPQ_Pdx')]]
+                from_result.pop(self.parent.variable, None)
             if self.child.unpack_list:
                 list_result = from_result.pop(self.child.variable)
                 for result in list_result:
                     result = _utf8(result)
-                    results[result] = {**from_result,
-                                       self.child.variable: result}
+                    rows[result] = {**from_result, self.child.variable: result}
             else:
-                results[from_result[self.child.variable]] = from_result
-        log.debug(f"{len(results)} results")
-        # query q_where using each child
-        if self.q_where:
-            for key, result in dict(results).items():
-                child_value_str = _utf8(key).replace("'", "\\'")
-                this_q_where = q_where.replace(self.child.variable,
-                                               f"'{child_value_str}'")
-                where_query = self.pl.query(this_q_where)
-                if (where_result := next(where_query, False)) is not False:
-                    result.update(where_result)
-                elif not self.null:
-                    del results[key]
-                list(where_query)
-        log.debug(f"now {len(results)} results")
-
-        self._results = IndexedOrderedDict()
+                rows[from_result[self.child.variable]] = from_result
+        log.debug(f"{solutions} solutions")
+        # query q_where using batches of children
+        if self.q_where and parents is None:
+            self._where(self._where_goal.call(None, self._parent_value()),
+                        self.child.variable,
+                        [(_pl_term(key), results, key) for key in results])
+        elif self.q_where:
+            self._where(self._where_goal.call(None, None),
+                        f"{self.child.variable}-{self.parent.variable}",
+                        [(f"{_pl_term(key)}-{_pl_term(parent)}", rows, key)
+                         for parent, rows in results.items() for key in rows])
+        return results, solutions
+
+    def _where(self, q_where, pattern, entries):
+        """Evaluate q_where for (term, results, key) entries in batches.
+
+        pattern (the child variable, or Child-Parent) is unified with each
+        term in turn and the first q_where solution is added to results[key],
+        as if q_where was queried once per child. Keys without a solution are
+        removed from their results unless the query is NULL.
+        """
+        if self.null:
+            where_expr = f"(once(({q_where})) -> true ; true)"
+        else:
+            where_expr = f"once(({q_where}))"
+        pattern_vars = _goal_vars(pattern)
+        for start in range(0, len(entries), self.where_batch):
+            batch = entries[start:start+self.where_batch]
+            term_list = ", ".join(term for term, _, _ in batch)
+            matched = set()
+            for where_result in self.pl.query(
+                    f"nth0(RPQ_Idx, [{term_list}], {pattern}), " + where_expr):
+                idx = where_result.pop('RPQ_Idx')
+                for var in pattern_vars:
+                    del where_result[var]
+                _, results, key = batch[idx]
+                results[key].update({var: val for var, val
+                                     in where_result.items()
+                                     if not isinstance(val, easy.Variable)})
+                matched.add(idx)
+            if not self.null:
+                for idx, (_, results, key) in enumerate(batch):
+                    if idx not in matched:
+                        del results[key]
+
+    def _add_results(self, results, ordered=False):
+        """Format results with q_as into self._results, ordered by q_by
+        unless they are already ordered.
+
+        Each row is formatted (and its sort key built) once, then sorted on
+        the plain string (or natural sort) key.
+        """
         q_as = VarList(self.q_as) if self.q_as else VarList(self.child.variable)
+        rows = [(key, q_as.result(**vals)) for key, vals in results.items()]
         # sort results using q_by varlist
-        if self.q_by is None:
-            q_by = q_as
+        if ordered:
+            sort_keys = None
+        elif self.q_by is None:
+            sort_keys = [str(result) for _, result in rows]
+        elif self.q_by:
+            q_by = VarList(self.q_by)
+            sort_keys = [str(q_by.result(**results[key])) for key, _ in rows]
         else:
-            q_by = self.q_by
+            sort_keys = None
+        if sort_keys is not None:
+            if self.natural:
+                sort_keys = [_natural_key(sort_key) for sort_key in sort_keys]
+            rows = [row for _, row in sorted(zip(sort_keys, rows),
+                                             key=itemgetter(0))]
 
         val_set = set()
-        if q_by:
-            q_by = VarList(q_by)
-            for key in sorted(results, key=lambda k: q_by.result(**results[k])):
-                result = q_as.result(**results[key])
-                # if unique delete keys with identical print forms
-                if self.unique and str(result) in val_set:
-                    continue
-                val_set.add(str(result))
-                self._results[key] = result
-        else:
-            for key in results:
-                result = q_as.result(**results[key])
-                if self.unique and str(result) in val_set:
+        for key, result in rows:
+            # if unique delete keys with identical print forms
+            if self.unique:
+                if str(result) in val_set:
                     continue
                 val_set.add(str(result))
-                self._results[key] = result
-
-        return self._results
+            self._results[key] = result
+
+    def _cache_key(self):
+        """Identity of this query's results in the shared result cache."""
+        q_as, q_by = [tuple(q) if isinstance(q, list) else q
+                      for q in (self.q_as, self.q_by)]
+        parent = self.parent.resource if self.parent else None
+        return (self._from_goal.name, getattr(self._where_goal, 'name', None),
+                self.child.variable, q_as, q_by, self.unique, self.null,
+                self.natural, parent)
+
+    def _compile(self):
+        """Assert q_from and q_where as clauses parameterized by the parent.
+
+        The child's type expression is compiled into whichever goal the child
+        is bound by. q_where takes the child as its first parameter.
+        """
+        if self._from_goal is not None:
+            return
+        q_from, q_where = self.q_from, self.q_where
+        # add term querying type of the child
+        if self.child.rdf_type is not False:
+            type_expr = f", xcat_type({self.child.variable}, RPQ_KeyType)"
+            if isinstance(self.child.rdf_type, str):
+                type_expr = (", rdfs_subclass_of(RPQ_KeyType, "
+                             f"'{self.child.rdf_type}')" + type_expr)
+            if self.child.unpack_list and q_where:
+                q_where += type_expr
+            else:
+                q_from += type_expr
+        params = [self.parent.variable] if self.parent else []
+        self._from_goal = CompiledGoal(self.pl, q_from, params)
+        if q_where:
+            self._where_goal = CompiledGoal(self.pl, q_where,
+                                            [self.child.variable] + params)
 
     def items(self):
         return self._query().items()
@@ -242,16 +474,137 @@ class RPQuery:
     def __len__(self):
         return len(self._query())
 
+    def index(self, key):
+        """Position of key in the results."""
+        results = self._query()
+        # keys are only appended (by fetch_more) after the first lookup
+        for idx in range(len(self._positions), len(results)):
+            self._positions[results.keys()[idx]] = idx
+        return self._positions[key]
+
     def first_item(self):
         if len(self):
             return self[self.keys()[0]]
         else:
             return {}
 
+    def prefetch_children(self):
+        """Load the child queries of every result in (batches of) one goal.
+
+        The descendant query is called with the parent bound by nth0/3 to
+        each of this query's keys, and its solutions bucketed by parent, so
+        expanding the tree costs a few queries per level instead of one (or
+        two, with WHERE) per node.
+        """
+        self._prefetch([(self, key) for key in self._query()])
+
+    @staticmethod
+    def _prefetch(entries):
+        """prefetch_children for the (query, key) entries of queries sharing
+        a descendant query."""
+        entries = [(query, key) for query, key in entries
+                   if key not in query._children]
+        if not entries:
+            return
+        first = entries[0][0]
+        desc = first if first.recursive else first.desc_q
+        if desc is None:
+            return
+        desc._compile()
+        parents = list(dict.fromkeys(key for _, key in entries))
+        children = {}
+        for start in range(0, len(parents), desc.where_batch):
+            batch = parents[start:start+desc.where_batch]
+            term_list = ", ".join(_pl_term(parent) for parent in batch)
+            buckets, _ = desc._fetch(
+                f"nth0(RPQ_Pdx, [{term_list}], {desc.parent.variable}), "
+                + desc._from_goal.call(None), batch)
+            for parent, results in buckets.items():
+                child = desc.copy(parent)
+                child._results = IndexedOrderedDict()
+                child._add_results(results)
+                child.complete = True
+                children[parent] = child
+        for query, key in entries:
+            query._children[key] = children[key]
+
+    def tree_items(self, batch=None):
+        """Yield (key path, result) for every result in the query's tree.
+
+        The tree is loaded level by level, a page of a paged query at a time,
+        prefetching the child queries of up to batch (or where_batch) results
+        of a level at once, so the work between two items stays bounded.
+        """
+        batch = batch or self.where_batch
+        level = [((), self)]
+        while level:
+            next_level = []
+            # (path, query, key) of the results whose children aren't loaded
+            pending = []
+            for path, query in level:
+                idx = 0
+                while idx < len(query) or query.fetch_more():
+                    key = query.keys()[idx]
+                    idx += 1
+                    yield path + (key,), query[key]
+                    # don't follow cycles in recursive queries
+                    if key not in path:
+                        pending.append((path, query, key))
+                    if len(pending) >= batch:
+                        next_level += self._next_level(pending)
+                        pending = []
+            next_level += self._next_level(pending)
+            level = next_level
+
+    @classmethod
+    def _next_level(cls, pending):
+        """Prefetch the children of (path, query, key) results. Return the
+        (path, child query) of those with children."""
+        cls._prefetch([(query, key) for _, query, key in pending])
+        return [(path + (key,), child) for path, query, key in pending
+                if isinstance(child := query._children.get(key), RPQuery)
+                and child]
+
+    def has_children(self, child):
+        """Whether child_query(child) has results, without running it.
+
+        Unless the child query is already loaded, this is a once/1 probe of
+        the descendant query's FROM and WHERE, which share only the child
+        variable, as in _where. Prefetching is left to child_query, when the
+        node is expanded.
+        """
+        if child in self._children:
+            return len(self.child_query(child)) > 0
+        desc = self if self.recursive else self.desc_q
+        if desc is None:
+            return False
+        desc._compile()
+        p_value = _pl_term(child)
+        # FROM's other variables are named apart from WHERE's
+        rename = {var: f"RPQ_From_{var}" for var in desc._from_goal.variables
+                  if var != desc.child.variable}
+        if desc.child.unpack_list:
+            rename[desc.child.variable] = 'RPQ_List'
+            probe = [desc._from_goal.call(p_value, rename=rename),
+                     f"member({desc.child.variable}, RPQ_List)"]
+        else:
+            probe = [desc._from_goal.call(p_value, rename=rename)]
+        if desc.q_where and not desc.null:
+            probe.append(desc._where_goal.call(None, p_value))
+        query = self.pl.query(f"once(({', '.join(probe)}))")
+        if next(query, False) is not False:
+            list(query)
+            return True
+        return False
+
     def child_query(self, child):
         #log.debug(self._children)
         if child in self._children:
             return self._children[child]
+        if self.prefetch and child in self._query():
+            self.prefetch_children()
+            if child in self._children:
+                return self._children[child]
         if child not in self._results:
             log.debug(self._results)
             log.debug(self.parent)
@@ -283,6 +636,12 @@ class RPQuery:
             flag_string += ['(null)']
         if self.child.rdf_type is False:
             flag_string += ['(no child type)']
+        if self.paged:
+            flag_string += [f'(pages of {self.page_size})']
+        if self.natural:
+            flag_string += ['(natural sort)']
+        if self.prefetch:
+            flag_string += ['(prefetch)']
         if self._results is not None:
             flag_string += [f'({len(self._results)} results)']
         if flag_string:
@@ -294,10 +653,50 @@ class RPQuery:
         return string
 
 
+class CompiledGoal:
+    """A prolog goal asserted once as a clause with parameters as arguments.
+
+    'rdf(P, X, Y)' with parameter P is asserted as the clause
+    'rpq_q_<n>(P, X, Y) :- rdf(P, X, Y)' and called by binding P. The goal's
+    other variables keep their names so query results are unchanged.
+    Identical goals share a clause.
+    """
+    _clauses = {}
+
+    def __init__(self, pl, goal, params=()):
+        self.params = list(params)
+        self.variables = [var for var in _goal_vars(goal)
+                          if var not in self.params]
+        key = (goal, tuple(self.params))
+        if key not in self._clauses:
+            name = f"rpq_q_{len(self._clauses)}"
+            head = f"{name}({', '.join(self.params + self.variables)})"
+            log.debug(f"{head} :- {goal}")
+            list(pl.query(f"assertz(({head} :- {goal}))"))
+            self._clauses[key] = name
+        self.name = self._clauses[key]
+
+    def call(self, *values, rename=None):
+        """Goal calling the clause with params bound to (term string) values.
+
+        Params without a value (or None) are left as unbound variables.
+        rename maps variables to other names to use in the call.
+        """
+        args = [param if value is None else value for param, value
+                in zip(self.params, values + (None,) * len(self.params))]
+        variables = [rename.get(var, var) for var in self.variables
+                     ] if rename else self.variables
+        return f"{self.name}({', '.join(args + variables)})"
+
+
 class RPQ:
+    cache = RPQuery.cache
+
     def __init__(self, *consult_files, write_mode=False):
         self._pl = Prolog()
         self.write_mode = write_mode
+        # the RPTransaction collecting asserts in a transaction() block
+        self.batch = None
         for consult_file in consult_files:
             self._pl.consult(consult_file)
         if write_mode is True:
@@ -318,13 +717,19 @@ class RPQ:
         return RPQuery(self._pl, *args, **kwargs)
 
 
-    def querylist(self, queries):
+    def querylist(self, queries, prefetch=False):
+        """Chain queries as the desc_q of the query before them.
+
+        With prefetch, each level's child queries are loaded for all of its
+        results at once (see RPQuery.prefetch_children).
+        """
         desc_query = None
         for query in reversed(queries):
             if isinstance(query, ProtoQuery):
                 desc_query = RPQuery(self._pl, query.child, query.q_from,
                                      query.q_as, query.parent, query.q_where,
-                                     desc_q=desc_query, **query.kwargs)
+                                     desc_q=desc_query, prefetch=prefetch,
+                                     **query.kwargs)
                 continue
             args = []
             kwargs = {}
@@ -336,7 +741,8 @@ class RPQ:
                     if isinstance(obj, dict):
                         kwargs = obj
                         args.pop(idx)
-            desc_query = RPQuery(self._pl, *args, desc_q=desc_query, **kwargs)
+            desc_query = RPQuery(self._pl, *args, desc_q=desc_query,
+                                 prefetch=prefetch, **kwargs)
         return desc_query
 
 
@@ -361,36 +767,94 @@ class RPQ:
             return _utf8(results[0].pop(next(iter(results[0])), None))
 
 
+    @contextmanager
+    def transaction(self):
+        """Commit every rassert in the with block as one rdf_transaction.
+
+        The asserts are collected, and run when the block ends, so they
+        return None instead of their solutions, and queries in the block
+        don't see them yet. If any of them has no solution, or the block
+        raises, none of them are committed. Yields the RPTransaction, whose
+        committed flag tells which. Nested blocks join the outer one.
+        """
+        if self.batch is not None:
+            yield self.batch
+            return
+        self.batch = RPTransaction()
+        try:
+            yield self.batch
+        finally:
+            batch, self.batch = self.batch, None
+        batch.commit(self._pl, self.write_mode)
+
+
     def rassert(self, *statements):
+        if self.batch is not None:
+            self.batch.rassert(*statements)
+            return None
         return RPAssert(self._pl, *statements, write_mode=self.write_mode
                         ).execute()
 
 
     def new_bnode(self):
-        result = RPAssert(self._pl, "rdf_create_bnode(X)",
-                          write_mode=self.write_mode).execute()
-        return result[0]['X']
+        # doesn't touch the store, so it needn't wait for a transaction
+        result, = self._pl.query("rdf_create_bnode(X)")
+        return result['X']
 
 
     def new_seq(self, term_list):
+        if self.batch is not None:
+            raise Exception("new_seq can't be collected by a transaction, "
+                            "assert the seq with a variable instead")
         result = RPAssert(self._pl, f"rdf_assert_seq(X, {term_list})",
                           write_mode=self.write_mode).execute()
         return result[0]['X']
 
 
     def TrackList(self, release, term_list):
-        seq = self.new_seq(term_list)
-        return RPAssert(self._pl,
-                f"rdf_retractall('{seq}', '{RDF.type}', '{RDF.Seq}')",
-                f"rdf_assert('{seq}', '{RDF.type}', '{XCAT.TrackList}')",
-                f"rdf_assert('{release}', '{XCAT.tracklist}', '{seq}')"
-        ).execute()
+        return self.rassert(
+            f"rdf_assert_seq(Seq, {term_list})",
+            f"rdf_retractall(Seq, '{RDF.type}', '{RDF.Seq}')",
+            f"rdf_assert(Seq, '{RDF.type}', '{XCAT.TrackList}')",
+            f"rdf_assert('{release}', '{XCAT.tracklist}', Seq)")
 
 
     def uns_query(self, query):
         return list(self._pl.query(query))
 
 
+class RPTransaction:
+    """The asserts collected by RPQ.transaction(), committed together."""
+    def __init__(self):
+        self.goals = []
+        # called once the asserts are committed
+        self.on_commit = []
+        self.committed = False
+
+
+    def rassert(self, *statements):
+        self.goals.append(", ".join(statements))
+
+
+    def commit(self, pl, write_mode=False):
+        """Assert every collected goal in one rdf_transaction, each with all
+        of its solutions. Returns whether it was committed."""
+        if not self.goals:
+            self.committed = True
+        else:
+            # findall keeps each goal's variables apart from the others'
+            self.committed = bool(RPAssert(
+                pl, *(f"findall(t, ({goal}), [_|_])" for goal in self.goals),
+                write_mode=write_mode).execute())
+        if self.committed:
+            for callback in self.on_commit:
+                callback()
+        else:
+            log.warning(f"rolled back a transaction of {len(self.goals)} "
+                        "asserts")
+        return self.committed
+
+
 class RPAssert:
     _enter = "rdf_write"
     _exit = "rdf_read"
@@ -403,18 +867,105 @@ class RPAssert:
     def execute(self):
         if not self.write_mode:
             log.debug(list(self.pl.query(self._enter)))
+        goal = ", ".join(self.statements)
         log.debug("ASSERT\n" + ",\n".join(self.statements))
-        res = list(self.pl.query(", ".join(self.statements)))
+        # all solutions of the statements are committed at once, or nothing
+        # is if they have none
+        variables = [var for var in _goal_vars(goal) if var[0] != '_']
+        res = []
+        for solutions in self.pl.query(
+                f"rdf_transaction((findall([{', '.join(variables)}], "
+                f"({goal}), RPQ_Solutions), RPQ_Solutions \\== []))"):
+            res = [dict(zip(variables, solution))
+                   for solution in solutions['RPQ_Solutions']]
+        RPQuery.cache.invalidate()
         log.debug(res)
         if not self.write_mode:
             log.debug(list(self.pl.query(self._exit)))
         return res
 
 
+class TripleLoader:
+    """Collects triples and asserts each batch of them with a single
+    maplist(rdf_assert) goal, instead of one rdf_assert goal per triple.
+
+    Subjects and predicates are URIs. Objects are URIs, or literal terms
+    from xsd_type.
+    """
+    def __init__(self, rpq, batch_size=10000):
+        self.rpq = rpq
+        self.batch_size = batch_size
+        self.triples = []
+        # {key: callable} to call once the collected triples are asserted
+        self.on_flush = {}
+        self.count = 0
+        self.elapsed = 0.0
+
+
+    def add(self, subj, pred, obj):
+        self.triples.append((subj, pred, obj))
+        if len(self.triples) >= self.batch_size:
+            self.flush()
+
+
+    def goal(self):
+        """Goal asserting the collected triples."""
+        if not self.triples:
+            return "true"
+        subjs, preds, objs = zip(*self.triples)
+        objs = [obj if isinstance(obj, PlTerm) else escape_string(obj)
+                for obj in objs]
+        return (f"maplist(rdf_assert, [{', '.join(map(escape_string, subjs))}]"
+                f", [{', '.join(map(escape_string, preds))}], "
+                f"[{', '.join(objs)}])")
+
+
+    def flush(self):
+        if not self.triples:
+            return
+        start = time.perf_counter()
+        if (batch := self.rpq.batch) is not None:
+            # counted once the transaction() block commits
+            batch.rassert(self.goal())
+            batch.on_commit.append(self._take())
+        elif self.rpq.rassert(self.goal()):
+            self._take()()
+        else:
+            raise Exception(f"asserting {len(self.triples)} triples was "
+                            "rolled back")
+        self.elapsed += time.perf_counter() - start
+
+
+    def asserted(self):
+        """Start over once the goal() of the collected triples is asserted,
+        by flush() or by a caller's own rassert."""
+        self._take()()
+
+
+    def _take(self):
+        """Clear the collected triples. Returns the callable counting them
+        and calling their on_flush callbacks, for once they are asserted."""
+        count, on_flush = len(self.triples), self.on_flush
+        self.triples, self.on_flush = [], {}
+
+        def asserted():
+            self.count += count
+            for callback in on_flush.values():
+                callback()
+        return asserted
+
+
+    def rate(self):
+        """Triples asserted per second spent asserting them."""
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+
 class VarList:
     _var = 'RPQ_A'
 
     def __init__(self, *args, var_list=None, print_str=None):
+        # {result variable names: column index shared by QueryResults}
+        self._columns = {}
         if args and isinstance(args[0], VarList):
             self.print_str = args[0].print_str
             self.var_list = args[0].var_list
@@ -466,20 +1017,33 @@ class VarList:
 
 
     def result(self, *args, **kwargs):
-        val_dict = {key: None for key in self.var_list}
+        columns = self._column_index(tuple(kwargs))
+        values = [None] * len(columns)
         for key, value in kwargs.items():
-            val_dict[key] = _utf8(value)
+            values[columns[key]] = (value if value.__class__ is str
+                                    else _utf8(value))
         for value in args:
-            for val in val_dict:
-                if not isinstance(val_dict[val], str):
-                    val_dict[val] = _utf8(value)
+            for idx, val in enumerate(values):
+                if not isinstance(val, str):
+                    values[idx] = _utf8(value)
                     break
-        for key, val in val_dict.items():
-            if val is None:
-                val_dict[key] = "."
+        values = tuple("." if val is None else val for val in values)
         if callable(self.print_str):
-            return QueryResult(self.print_str(val_dict), val_dict)
-        return QueryResult(self.print_str.format(*val_dict.values()), val_dict)
+            string = self.print_str(dict(zip(columns, values)))
+        else:
+            # str.format ignores the trailing (non print) columns
+            string = self.print_str.format(*values)
+        return QueryResult(string, values, columns)
+
+
+    def _column_index(self, keys):
+        """Column index for results of the print variables and keys."""
+        if (columns := self._columns.get(keys)) is None:
+            names = self.var_list + [key for key in keys
+                                     if key not in self.var_list]
+            columns = {name: idx for idx, name in enumerate(names)}
+            self._columns[keys] = columns
+        return columns
 
 
     def __repr__(self):
@@ -490,10 +1054,30 @@ class VarList:
 
 @total_ordering
 class QueryResult:
-    def __init__(self, string, vals):
+    """A formatted result row.
+
+    Values are held in a tuple, columns is a {name: position} index shared by
+    the rows of a query. vals may also be given as a dict without columns.
+    """
+    __slots__ = ('string', '_values', '_columns')
+
+    def __init__(self, string, vals, columns=None):
+        if columns is None:
+            columns = {name: idx for idx, name in enumerate(vals)}
+            vals = tuple(vals.values())
         self.string = string
-        self.vals = vals
-        self.type = vals.get('RPQ_KeyType')
+        self._values = vals
+        self._columns = columns
+
+
+    @property
+    def vals(self):
+        return dict(zip(self._columns, self._values))
+
+
+    @property
+    def type(self):
+        return self.get('RPQ_KeyType')
 
 
     def __str__(self):
@@ -505,14 +1089,13 @@ class QueryResult:
 
 
     def __getitem__(self, key):
-        return self.vals[key]
+        return self._values[self._columns[key]]
 
 
     def get(self, key, default=None):
-        try:
-            return self.vals[key]
-        except KeyError:
+        if (idx := self._columns.get(key)) is None:
             return default
+        return self._values[idx]
 
 
     def __lt__(self, other):
@@ -524,6 +1107,13 @@ class QueryResult:
 
 
 def rdf_unify(rpq, terms):
+    uri, update_list = _unify_updates(terms)
+    rpq.rassert(*update_list)
+    return uri
+
+
+def _unify_updates(terms):
+    """The uri to unify terms into and the rdf_update goals doing it."""
     bnodes = [t for t in terms if '_:genid' == t[:7]]
     uris = [t for t in terms if '_:genid' != t[:7]]
     log.debug(f"unifying: {bnodes} with {uris}")
@@ -539,8 +1129,67 @@ def rdf_unify(rpq, terms):
             f"rdf_update('{node}', _, _, subject('{uri}'))",
             f"rdf_update(_, _, '{node}', object('{uri}'))"
         ]
-    rpq.rassert(*update_list)
-    return uri
+    return uri, update_list
+
+
+class LabelIndex:
+    """{(rdf:type, xcat:name): uri} of the resources of some types.
+
+    Loaded from the store once, with one query per type, and kept up to date
+    with add(). Labels are xsd:string literals as made by xsd_type. Labels
+    shared by several resources of a type are kept in duplicates until
+    unify() merges them all in one transaction.
+    """
+    def __init__(self, rpq, types):
+        self.rpq = rpq
+        self.uris = {}
+        # {(type, label): [uris]} of labels with more than one resource
+        self.duplicates = {}
+        for _type in types:
+            for res in rpq.uns_query(
+                    f"rdf(X, '{RDF.type}', '{_type}'), "
+                    f"rdf(X, '{XCAT.name}', Name^^'{XSD.string}')"):
+                key = (str(_type), xsd_type(_utf8(res['Name']), 'string'))
+                uri = _utf8(res['X'])
+                if (known := self.uris.setdefault(key, uri)) != uri:
+                    cluster = self.duplicates.setdefault(key, [known])
+                    if uri not in cluster:
+                        cluster.append(uri)
+
+
+    def __len__(self):
+        return len(self.uris)
+
+
+    def get(self, _type, label):
+        return self.uris.get((str(_type), str(label)))
+
+
+    def add(self, _type, label, uri):
+        """Index uri under label, unless the label already has a resource."""
+        return self.uris.setdefault((str(_type), str(label)), uri)
+
+
+    def unify(self):
+        """rdf_unify every cluster of duplicates in a single transaction.
+
+        Returns the number of resources merged into others.
+        """
+        update_list = []
+        merged = 0
+        for key, terms in self.duplicates.items():
+            try:
+                uri, updates = _unify_updates(terms)
+            except Exception as e:
+                log.warning(f"not unifying {key}: {terms}\n{e}")
+                continue
+            self.uris[key] = uri
+            update_list += updates
+            merged += len(terms) - 1
+        if update_list:
+            self.rpq.rassert(*update_list)
+        self.duplicates = {}
+        return merged
 
 
 def sort_uris(uri_list):
@@ -624,6 +1273,38 @@ def _utf8(var):
         raise Exception(f"implement {type(var)}")
 
 
+_pl_token = re.compile(r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*"|0'.|\w+""")
+
+def _goal_vars(goal):
+    """Named variables of a prolog goal string, in order of appearance."""
+    variables = []
+    for token in _pl_token.findall(goal):
+        if ((token[0].isupper() or token[0] == '_') and token != '_'
+                and token not in variables):
+            variables.append(token)
+    return variables
+
+
+_digits = re.compile(r'(\d+)')
+
+def _natural_key(string):
+    """Sort key comparing runs of digits in a string by their numeric value."""
+    return tuple(int(frag) if idx % 2 else frag
+                 for idx, frag in enumerate(_digits.split(string)))
+
+
+def _pl_term(value):
+    """Prolog term for a value returned by a query, for use in a new goal."""
+    value = _utf8(value)
+    if isinstance(value, int):
+        return str(value)
+    return escape_string(value)
+
+
+class PlTerm(str):
+    """Prolog term string, as opposed to an atom still to be quoted."""
+
+
 def xsd_type(literal, xsd_t):
     if isinstance(literal, str):
         literal = escape_string(literal)
@@ -631,14 +1312,27 @@ def xsd_type(literal, xsd_t):
         pass
     else:
         raise Exception(f"implement {type(literal)}")
-    return f"{literal}^^'{XSD[xsd_t]}'"
+    return PlTerm(f"{literal}^^'{XSD[xsd_t]}'")
 
 
 def escape_string(literal):
     return "'" + literal.replace("'", "\\'") + "'"
 
 
-def LDateTime(rpq, **kwargs):
+# the LDateTime URIs in the store, loaded by the first LDateTime call
+_ldatetimes = None
+
+
+def LDateTime(rpq, triples=None, **kwargs):
+    """URI of the LDateTime of the given year, month, day, ... , created
+    if the store doesn't have it yet.
+
+    Known URIs are kept for the whole process, so only a new date costs
+    anything. It is asserted right away, or added to triples, a
+    TripleLoader, to be asserted with its batch. The URI is only known once
+    its triples are asserted.
+    """
+    global _ldatetimes
     argnames = ('year', 'month', 'day', 'hour', 'minute', 'second')
     xsdtypes = ('gYear', 'gMonth', 'gDay', *(['nonNegativeInteger'] * 3))
 
@@ -650,49 +1344,50 @@ def LDateTime(rpq, **kwargs):
             dt_uri += '.' + str(dt_frag).rjust(2, '0')
         else:
             break
-    if not rpq.boolquery(f"rdf('{dt_uri}', '{RDF.type}', '{XCAT.LDateTime}')"):
-        assert_list = [
-            f"rdf_assert('{dt_uri}', '{RDF.type}', '{XCAT.LDateTime}')"
-        ] + [
-            f"rdf_assert('{dt_uri}', '{pred}', {obj})" for pred, obj in dt_preds
-        ]
-        rpq.rassert(*assert_list)
+    if _ldatetimes is None:
+        _ldatetimes = {_utf8(res['X']) for res in rpq.uns_query(
+            f"rdf(X, '{RDF.type}', '{XCAT.LDateTime}')")}
+    if dt_uri not in _ldatetimes:
+        loader = TripleLoader(rpq) if triples is None else triples
+        if dt_uri not in loader.on_flush:
+            loader.add(dt_uri, RDF.type, XCAT.LDateTime)
+            for pred, obj in dt_preds:
+                loader.add(dt_uri, pred, obj)
+            loader.on_flush[dt_uri] = partial(_ldatetimes.add, dt_uri)
+        if triples is None:
+            loader.flush()
     return dt_uri
 
 
 def TrackList(rpq, term_list):
-    seq = rpq.new_seq(term_list)
-    rpq.rassert(f"rdf_retractall('{seq}', '{RDF.type}', '{RDF.Seq}')",
-                f"rdf_assert('{seq}', '{RDF.type}', '{XCAT.TrackList}')")
-    return seq
+    result, = rpq.rassert(
+        f"rdf_assert_seq(Seq, {term_list})",
+        f"rdf_retractall(Seq, '{RDF.type}', '{RDF.Seq}')",
+        f"rdf_assert(Seq, '{RDF.type}', '{XCAT.TrackList}')")
+    return result['Seq']
 
 
-def nometa_file_node(rpq, data):
+def nometa_file_node(rpq, data, triples=None):
     #TODO fix this bad gross interface
-    file_path = xsd_type(data['path'], 'string')
-    _hash = xsd_type(data['_hash'], 'string')
+    loader = triples or TripleLoader(rpq)
     file_URN = B3[data['_hash']]
-    rpq.rassert(*[
-        f"rdf_assert('{file_URN}', '{RDF.type}', '{XCAT.File}')",
-        f"rdf_assert('{file_URN}', '{XCAT.path}', {file_path})",
-        f"rdf_assert('{file_URN}', '{XCAT.hash}', {_hash})",
-    ])
+    loader.add(file_URN, RDF.type, XCAT.File)
+    loader.add(file_URN, XCAT.path, xsd_type(data['path'], 'string'))
+    loader.add(file_URN, XCAT.hash, xsd_type(data['_hash'], 'string'))
+    if not triples:
+        loader.flush()
     return file_URN
 
 
-def entries_to_dir(rpq, dir_hash, dirpath, dir_entries):
+def entries_to_dir(rpq, dir_hash, dirpath, dir_entries, triples=None):
     #, subdir_hashes):
-    path = xsd_type(dirpath, 'string')
+    loader = triples or TripleLoader(rpq)
     dir_URN = B3[dir_hash]
-    dir_hash = xsd_type(dir_hash, 'string')
-    assert_list = [
-        f"rdf_assert('{dir_URN}', '{RDF.type}', '{XCAT.Directory}')",
-        f"rdf_assert('{dir_URN}', '{XCAT.path}', {path})",
-        f"rdf_assert('{dir_URN}', '{XCAT.hash}', {dir_hash})",
-    ] + [f"rdf_assert('{dir_URN}', '{XCAT.dirEntry}', '{entry}')"
-         for entry in dir_entries
-    ] # i swear this is redundant but didn't re-test
-    #+ [f"rdf_assert('{dir_URN}', '{XCAT.dirEntry}', '{B3[subdir_hash]}')"
-    #     for subdir_hash in subdir_hashes
-    #]
-    rpq.rassert(*assert_list)
+    loader.add(dir_URN, RDF.type, XCAT.Directory)
+    loader.add(dir_URN, XCAT.path, xsd_type(dirpath, 'string'))
+    loader.add(dir_URN, XCAT.hash, xsd_type(dir_hash, 'string'))
+    # i swear this is redundant but didn't re-test
+    for entry in dir_entries:
+        loader.add(dir_URN, XCAT.dirEntry, entry)
+    if not triples:
+        loader.flush()
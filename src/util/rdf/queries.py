@@ -49,7 +49,7 @@ tree_views = {
                    '[{Class}] {Label} <{URI}>',
                    ParentVar('InstanceClass', resource=RDFS.Resource),
                    'xcat_print(URI, Class, Label)',
-                   null=True)
+                   null=True, page_size=500)
     ], 'artist_releases': [
         ProtoQuery(ChildVar('Artist', rdf_type=False),
                    'rdfs_individual_of(Artist, Class), '
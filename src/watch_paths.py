@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+from sys import stdout
+from datetime import datetime
+from pprint import pformat
+
+from inotify_simple import INotify, flags
+
+from util.log import LogFormatter
+from util.rdf.b3 import HashCache, file_hash, hash_tree, hashlist_hash
+from util.rdf.pl import (RPQ, TripleLoader, xsd_type, escape_string,
+                         entries_to_dir, nometa_file_node)
+from util.rdf.namespaces import B3, XCAT
+from update_paths import reconcile
+
+log = logging.getLogger('watch_paths')
+
+WATCH_FLAGS = (flags.CLOSE_WRITE | flags.CREATE | flags.DELETE
+               | flags.MOVED_FROM | flags.MOVED_TO)
+
+
+class PathWatcher:
+    """Keep the DirEntries of some directory trees in the store up to date
+    with inotify.
+
+    The trees are watched from the start, but updates need the {path: hash}
+    of the trees, matching the store, from load().
+    """
+    def __init__(self, rpq, roots, cache, workers=8):
+        self.rpq = rpq
+        self.roots = roots
+        self.cache = cache
+        self.workers = workers
+        self.dirpaths = {}
+        # {hash: {paths}} of the DirEntries in the store
+        self.hashes = {}
+        # paths changed since the last update
+        self.dirty = set()
+        # whether inotify dropped events, so every path has to be rehashed
+        self.overflowed = False
+        self.inotify = INotify()
+        self.watches = {}
+        for root in roots:
+            self.watch_tree(root)
+
+
+    def load(self, dirpaths):
+        """Start from dirpaths, as from rec_file_hash, the store matches."""
+        self.dirpaths = dirpaths
+        self.hashes = {}
+        for path, _hash in dirpaths.items():
+            self.hashes.setdefault(_hash, set()).add(path)
+
+
+    def resync(self):
+        """Rehash the whole trees and reconcile the store with them, as
+        update_paths does, after re-adding any watches that were lost.
+
+        For the changes made while not watching, or whose events inotify
+        dropped.
+        """
+        start = time.perf_counter()
+        self.overflowed = False
+        self.dirty = set()
+        for dirpath in list(self.watches.values()):
+            if not os.path.isdir(dirpath):
+                self.unwatch_tree(dirpath)
+        for root in self.roots:
+            self.watch_tree(root)
+        dirpaths = {}
+        for root in self.roots:
+            dirpaths.update(self._hash_dir(root))
+        self.cache.commit()
+        added, moves, removed = reconcile(self.rpq, dirpaths)
+        self.load(dirpaths)
+        log.info(f"{added} added, {moves} moved, {removed} removed, "
+                 f"watching {len(self.watches)} directories: "
+                 f"{time.perf_counter() - start:.1f}s")
+
+
+    def watch_tree(self, top):
+        for dirpath, _, _ in os.walk(top):
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_FLAGS)
+            except OSError as e:
+                log.warning(f"can't watch {dirpath}: {e}")
+                continue
+            self.watches[wd] = dirpath
+
+
+    def unwatch_tree(self, top):
+        for wd, dirpath in list(self.watches.items()):
+            if dirpath == top or dirpath.startswith(top + os.sep):
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass # already gone with the directory
+
+
+    def read_events(self, timeout):
+        """Mark the paths of the events within timeout seconds dirty."""
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                log.warning("inotify queue overflowed, rehashing everything")
+                self.overflowed = True
+                continue
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            if (dirpath := self.watches.get(event.wd)) is None:
+                continue
+            path = os.path.join(dirpath, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & flags.MOVED_FROM:
+                    self.unwatch_tree(path)
+                elif event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self.watch_tree(path)
+            elif event.mask & flags.CREATE:
+                continue # wait for the file to be written
+            self.dirty.add(path)
+        return len(events)
+
+
+    def run(self, debounce=2.0, interval=30.0):
+        """Update the store once no events came for debounce seconds, or
+        at least every interval seconds while they keep coming."""
+        since = None
+        while True:
+            events = self.read_events(debounce)
+            if self.overflowed:
+                try:
+                    self.resync()
+                except Exception:
+                    log.exception("resync failed, trying again")
+                    self.overflowed = True
+                since = None
+                continue
+            if not self.dirty:
+                continue
+            since = since or time.monotonic()
+            if events and time.monotonic() - since < interval:
+                continue
+            try:
+                self.update()
+            except Exception:
+                log.exception("update failed, trying again with the next")
+            since = None
+
+
+    def update(self):
+        """Rehash the dirty paths and apply the changes to the store.
+
+        If anything fails, the hashes are put back and the paths marked
+        dirty again, for the next update to retry.
+        """
+        dirty, self.dirty = self.dirty, set()
+        # {path: hash before this update} of every path that was rehashed
+        old = {}
+        try:
+            self._update(dirty, old)
+        except Exception:
+            for path, _hash in old.items():
+                if _hash:
+                    self.dirpaths[path] = _hash
+                else:
+                    self.dirpaths.pop(path, None)
+            self.dirty |= dirty
+            raise
+
+
+    def _update(self, dirty, old):
+        start = time.perf_counter()
+
+        def set_hash(path, _hash):
+            old.setdefault(path, self.dirpaths.get(path))
+            if _hash:
+                self.dirpaths[path] = _hash
+            else:
+                self.dirpaths.pop(path, None)
+
+        ancestors = set()
+        for path in dirty:
+            if os.path.isfile(path):
+                try:
+                    stat = os.stat(path)
+                    if not (_hash := self.cache.get(path, stat)):
+                        _hash = file_hash(path)
+                        self.cache.put(path, stat, _hash)
+                except FileNotFoundError:
+                    _hash = None # removed again since the event
+                set_hash(path, _hash)
+            else:
+                # removed, or a directory to hash again as a whole
+                for known in [known for known in self.dirpaths
+                              if known == path
+                              or known.startswith(path + os.sep)]:
+                    set_hash(known, None)
+                if os.path.isdir(path):
+                    for known, _hash in self._hash_dir(path).items():
+                        set_hash(known, _hash)
+            ancestors.update(self._ancestors(path))
+
+        # directory hashes from the bottom up
+        for dirpath in sorted(ancestors, key=lambda p: p.count(os.sep),
+                              reverse=True):
+            set_hash(dirpath, hashlist_hash(child_hashes) if (
+                child_hashes := self._child_hashes(dirpath)) else None)
+        self.cache.commit()
+
+        changed = {path: _hash for path, _hash in old.items()
+                   if _hash != self.dirpaths.get(path)}
+        if changed:
+            self._apply(changed)
+        log.info(f"{len(dirty)} paths touched, {len(changed)} changed: "
+                 f"{time.perf_counter() - start:.3f}s")
+
+
+    def _hash_dir(self, top):
+        """{path: hash} of top and everything under it.
+
+        Like rec_file_hash, but empty directories are left out the way
+        _child_hashes leaves them out, instead of raising.
+        """
+        hashes = {}
+        for dirpath, subdirs, filenames, file_hashes in hash_tree(
+                top, self.workers, onerror=log.warning, cache=self.cache):
+            entry_hashes = [hashes[subdir_path] for subdir_path in
+                            (os.path.join(dirpath, subdir) for subdir in subdirs)
+                            if subdir_path in hashes]
+            for filename, filehash in zip(filenames, file_hashes):
+                hashes[os.path.join(dirpath, filename)] = filehash
+                entry_hashes.append(filehash)
+            if entry_hashes:
+                hashes[dirpath] = hashlist_hash(entry_hashes)
+        return hashes
+
+
+    def _ancestors(self, path):
+        """Directories from the parent of path up to its watched root."""
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                while path != root:
+                    path = os.path.dirname(path)
+                    yield path
+                return
+
+
+    def _child_hashes(self, dirpath):
+        if not os.path.isdir(dirpath):
+            return []
+        return [self.dirpaths[entry] for entry in
+                (os.path.join(dirpath, name) for name in os.listdir(dirpath))
+                if entry in self.dirpaths]
+
+
+    def _apply(self, changed):
+        """Update the store from the {path: old hash} of changed paths in
+        one transaction."""
+        # {hash: (paths in the store, paths after this update)}
+        touched = {}
+
+        def paths(_hash):
+            if _hash not in touched:
+                stored = self.hashes.get(_hash, set())
+                touched[_hash] = (stored, set(stored))
+            return touched[_hash][1]
+
+        for path, old_hash in changed.items():
+            if old_hash:
+                paths(old_hash).discard(path)
+            if (new_hash := self.dirpaths.get(path)):
+                paths(new_hash).add(path)
+
+        statements = []
+        triples = TripleLoader(self.rpq, batch_size=float('inf'))
+        for b3hash, (old_paths, new_paths) in touched.items():
+            file_uri = B3[b3hash]
+            if not new_paths:
+                log.debug(f"removed: {file_uri}\n{pformat(old_paths)}")
+                statements.append(f"xcat_retract({escape_string(file_uri)})")
+            elif not old_paths:
+                log.debug(f"new direntry: {file_uri}\n{pformat(new_paths)}")
+                for path in new_paths:
+                    if os.path.isdir(path):
+                        entries_to_dir(self.rpq, b3hash, path, [
+                            B3[child_hash] for child_hash
+                            in self._child_hashes(path)], triples)
+                    else:
+                        nometa_file_node(
+                            self.rpq, {'path': path, '_hash': b3hash}, triples)
+            else:
+                log.debug(f"\n\told: {pformat(old_paths - new_paths)}"
+                          f"\n\tnew: {pformat(new_paths - old_paths)}")
+                statements += [f"rdf_retractall('{file_uri}', '{XCAT.path}', "
+                               f"{xsd_type(path, 'string')})"
+                               for path in old_paths - new_paths]
+                statements += [f"rdf_assert('{file_uri}', '{XCAT.path}', "
+                               f"{xsd_type(path, 'string')})"
+                               for path in new_paths - old_paths]
+        if not self.rpq.rassert(*statements, triples.goal()):
+            raise Exception("the store update was rolled back")
+
+        # the store matches, so do the known hashes
+        for b3hash, (_, new_paths) in touched.items():
+            if new_paths:
+                self.hashes[b3hash] = new_paths
+            else:
+                self.hashes.pop(b3hash, None)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='folder(s) to watch', nargs="+")
+    parser.add_argument('--log', '-l', type=int, default=20, help=
+                        'output logging level (0-50), 0 prints all output')
+    parser.add_argument('--workers', '-j', type=int, default=8,
+                        help='number of files to hash in parallel')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help='seconds without changes to wait for before '
+                        'updating the store')
+    parser.add_argument('--interval', type=float, default=30.0,
+                        help='most seconds to hold off updates while '
+                        'changes keep coming')
+    args = parser.parse_args()
+
+    log.setLevel(args.log)
+    log_handler = logging.StreamHandler(stdout)
+    log_handler.setLevel(args.log)
+    log_handler.setFormatter(LogFormatter())
+    log.addHandler(log_handler)
+    log.info(f"\n\t\tRDF Path Watcher {datetime.now()}")
+
+    roots = [os.path.abspath(path) for path in args.input]
+    rpq = RPQ('init.pl')
+    with HashCache() as hash_cache:
+        # watch first, so changes made during the scan are caught up with by
+        # the first update
+        watcher = PathWatcher(rpq, roots, hash_cache, args.workers)
+        log.info(f"watching {len(watcher.watches)} directories")
+
+        # catch up with the changes made while not watching
+        watcher.resync()
+        watcher.run(args.debounce, args.interval)
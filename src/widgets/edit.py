@@ -235,6 +235,12 @@ class RecordingImport(ur.Columns):
 
 
     def add_recording(self):
+        with self.rpq.transaction():
+            self._add_recording()
+        self.update_resource()
+
+
+    def _add_recording(self):
         rec_uri = self.rpq.new_bnode()
         rec_props = self.new_rec["rec_props"]
         rec_is_prop = self.new_rec["rec_is_prop"]
@@ -255,7 +261,6 @@ class RecordingImport(ur.Columns):
             assertlist.append(
                 f"rdf_assert('{rec_uri}', '{RDF.type}', '{XCAT.Recording}')")
         self.rpq.rassert(*assertlist)
-        self.update_resource()
 
 
     def _assert(self, rec, prop, field, valtype=None, is_obj=False):
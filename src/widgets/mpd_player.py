@@ -3,9 +3,9 @@
 import logging as log
 from inspect import getmembers
 import urwid as ur
-import musicpd
 import time
 
+from util import mpd
 from util.table import balance_columns
 
 def format_track(dictlike):
@@ -19,14 +19,12 @@ def format_track(dictlike):
 
 
 class MpdPlayer(ur.Frame):
-    client = musicpd.MPDClient()
+    client = mpd.client
 
     def __init__(self, column_func=format_track, refresh=5, screen_refresh=1):
         self.refresh = refresh
         self.screen_refresh = screen_refresh
 
-        self.client.iterate = True
-
         col_headings = list(column_func({}).keys())
         col_headings.remove('key')
         col_headings.insert(0, ' ') # FIXME create list with this
@@ -46,16 +44,13 @@ class MpdPlayer(ur.Frame):
         if not self.body.keypress(size, key):
             return
         if (operation := OPERATION_MAP.get(key)):
-            self.client.connect(host="localhost")
             operation(self)
-            self.client.disconnect()
             self.reload()
         else:
             return key
 
 
     def reload(self):
-        self.client.connect(host="localhost")
         self.body.load_queue()
         paused = self.client.status().get('state') == 'pause'
         if (current := self.client.currentsong()):
@@ -67,7 +62,6 @@ class MpdPlayer(ur.Frame):
         self.footer.load_progress()
         self.footer.load_bar()
         self.footer.update_bar()
-        self.client.disconnect()
 
 
     def size_heading(self, col_widths):
@@ -97,6 +91,8 @@ class MpdPlayer(ur.Frame):
     def reload_screen(self):
         if self.footer.update_bar():
             self.reload()
+        else:
+            self.client.keep_alive()
 
 
 OPERATION_MAP = {
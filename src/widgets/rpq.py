@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import logging as log
+from array import array
+from bisect import bisect_left
+from itertools import islice
 
 import urwid as ur
 
@@ -66,9 +69,11 @@ class RPQ_NodeText(ur.TreeWidget):
 
 
 class RPQ_TreeNode(ur.TreeNode):
-    def __init__(self, parent_query, key, parent=None):
+    def __init__(self, parent_query, key, parent=None, index=None):
         value = parent_query[key]
         self.parent_query = parent_query
+        # position of key in parent_query
+        self._index = parent_query.index(key) if index is None else index
         self._prev_sibling = None
         self._next_sibling = None
         super().__init__(value, parent=parent, key=key)
@@ -79,14 +84,17 @@ class RPQ_TreeNode(ur.TreeNode):
             return None
         if self._next_sibling:
             return self._next_sibling
-        next_key_idx = self.parent_query.keys().index(self.get_key()) + 1
+        next_key_idx = self._index + 1
+        if next_key_idx == len(self.parent_query.keys()):
+            # load the next page of a paged query
+            self.parent_query.fetch_more()
         if next_key_idx < len(self.parent_query.keys()):
             #log.debug(next_key_idx)
             #log.debug(self.get_key())
             #log.debug(self.parent_query.keys())
             key = self.parent_query.keys()[next_key_idx]
             self._next_sibling = RPQ_Node(self.parent_query, key,
-                                          self.get_parent())
+                                          self.get_parent(), next_key_idx)
             self._next_sibling._prev_sibling = self
             return self._next_sibling
 
@@ -96,11 +104,11 @@ class RPQ_TreeNode(ur.TreeNode):
             return None
         if self._prev_sibling:
             return self._prev_sibling
-        next_key_idx = self.parent_query.keys().index(self.get_key()) - 1
+        next_key_idx = self._index - 1
         if (next_key_idx + 1):
             key = self.parent_query.keys()[next_key_idx]
             self._prev_sibling = RPQ_Node(self.parent_query, key,
-                                          self.get_parent())
+                                          self.get_parent(), next_key_idx)
             self._prev_sibling._next_sibling = self
             return self._prev_sibling
 
@@ -126,11 +134,11 @@ class RPQ_ParentNode(RPQ_TreeNode, ur.ParentNode):
         return node
 
 
-def RPQ_Node(parent_query, key, parent):
-    if len(parent_query.child_query(key)):
-        return RPQ_ParentNode(parent_query, key, parent)
+def RPQ_Node(parent_query, key, parent, index=None):
+    if parent_query.has_children(key):
+        return RPQ_ParentNode(parent_query, key, parent, index)
     else:
-        return RPQ_TreeNode(parent_query, key, parent)
+        return RPQ_TreeNode(parent_query, key, parent, index)
 
 
 class EditWindow(ur.WidgetWrap):
@@ -156,61 +164,125 @@ def EditWindows(root=None):
     return {subcls.name: subcls for subcls in EditWindow.__subclasses__()}
 
 
+class SearchIndex:
+    """Trigram index over the lowercased labels of every node in a query tree.
+
+    Entries are (key path, label) in the order RPQuery.tree_items loads them,
+    so repeated labels are separate entries. The tree is indexed as extend()
+    is called, and find only looks at the entries indexed so far.
+    """
+    # results whose child queries are prefetched at once while indexing
+    batch = 100
+
+    def __init__(self, query):
+        self.paths = []
+        self.labels = []
+        self.trigrams = {}
+        self.complete = False
+        self._items = query.tree_items(self.batch)
+
+    def extend(self, count=None):
+        """Index up to count more entries (all, if None). Return whether the
+        whole tree is indexed."""
+        start = len(self.paths)
+        for path, result in islice(self._items, count):
+            idx = len(self.paths)
+            label = str(result).lower()
+            self.paths.append(path)
+            self.labels.append(label)
+            for trigram in {label[i:i+3] for i in range(len(label) - 2)}:
+                if (postings := self.trigrams.get(trigram)) is None:
+                    postings = self.trigrams[trigram] = array('l')
+                postings.append(idx)
+        if count is None or len(self.paths) - start < count:
+            # the tree ran out before count entries
+            self.complete = True
+            log.debug(f"indexed {len(self.paths)} labels")
+        return self.complete
+
+    def find(self, match_string, start=0):
+        """Index of the first entry from start whose label has match_string."""
+        match_string = match_string.lower()
+        if len(match_string) < 3:
+            candidates = range(start, len(self.labels))
+        else:
+            # entries with the rarest trigram of the match string
+            candidates = min((self.trigrams.get(match_string[i:i+3], ())
+                              for i in range(len(match_string) - 2)), key=len)
+            candidates = islice(candidates, bisect_left(candidates, start),
+                                None)
+        for idx in candidates:
+            if match_string in self.labels[idx]:
+                return idx
+
+
 class SearchableTreeWalker(ur.TreeWalker):
     def __init__(self, first_node):
-        """
-        NOT GREAT search. in particualar there's an issue using the search field in this
-        naive recursive form. if theres a repeated string value, we stop recursing.
-        possible fixup would be to store a list of (node, searched) tuples as the search_field
-        values.
+        """Tree walker which can focus the node matching a search string.
+
+        Searches only find the nodes indexed so far, by build_index.
         """
         super().__init__(first_node)
-        self.search_field = {}
         if isinstance(first_node, RPQ_TreeNode):
-            node = first_node
-            while node:
-                self.search_field[node.get_value().string.lower()] = (node, False)
-                node = node.next_sibling()
+            self.query = first_node.parent_query
+        else:
+            self.query = None
+        # top level nodes by key, reused for later matches
+        self.top_nodes = {first_node.get_key(): first_node}
+        self.index = None
+        self.match = None
 
-    def find(self, match_string):
-        rec_search = []
-        match_string = match_string.lower()
-        for string, (node, searched) in self.search_field.items():
-            if match_string in string:
-                return node
-            elif not searched:
-                rec_search.append(string)
-        for string in rec_search:
-            if (result := self._rec_find(string, match_string)):
-                return result
-
-    def _rec_find(self, node_string, match_string):
-        #log.debug(self.search_field)
-        node, _ = self.search_field[node_string]
-        new_parents = []
-        if isinstance(node, RPQ_ParentNode):
-            match_node = None
-            #log.debug(list(node.get_child_keys()))
-            for key in node.get_child_keys():
-                #log.debug(key)
-                child_node = node.get_child_node(key)
-                new_string = child_node.get_value().string.lower()
-                #log.debug(new_string)
-                if not (item := self.search_field.get(new_string)):
-                    self.search_field[new_string] = (child_node, False)
-                    if isinstance(child_node, RPQ_ParentNode):
-                        new_parents.append(new_string)
-                if match_string in new_string:
-                    match_node = child_node
-            if match_node:
-                return match_node
-        self.search_field[node_string] = (node, True)
-        for parent_string in new_parents:
-            #log.info(parent_string)
-            if (match_node := self._rec_find(parent_string, match_string)):
-                return match_node
-
-    def match_select(self, string):
-        if (key := self.find(string)):
-            log.debug(key)
-            self.set_focus(key)
+    def find(self, match_string, next_match=False):
+        """Return the node of the first label containing match_string.
+
+        The search starts from the last match (after it, if next_match) and
+        wraps around to the top of the tree.
+        """
+        if not (self.query and match_string):
+            return
+        if self.index is None:
+            self.index = SearchIndex(self.query)
+        start = 0
+        if self.match is not None:
+            start = self.match + 1 if next_match else self.match
+        if (idx := self.index.find(match_string, start)) is None and start:
+            idx = self.index.find(match_string)
+        if idx is not None:
+            self.match = idx
+            return self._path_node(self.index.paths[idx])
+
+    def build_index(self, count=100):
+        """Index up to count more labels for searching. Return whether the
+        whole tree is indexed.
+
+        Besides the labels, this loads at most a page of a paged query and
+        the child queries of SearchIndex.batch results per label.
+        """
+        if not self.query:
+            return True
+        if self.index is None:
+            self.index = SearchIndex(self.query)
+        return self.index.complete or self.index.extend(count)
+
+    def _path_node(self, path):
+        """The walker's node at a key path, expanding its parents.
+
+        The top level node is made from its position in the query, and the
+        levels below are the child nodes of their parents, so the nodes
+        already loaded keep their expansion.
+        """
+        if (node := self.top_nodes.get(path[0])) is None:
+            node = self.top_nodes[path[0]] = RPQ_Node(
+                self.query, path[0], None, self.query.index(path[0]))
+        for key in path[1:]:
+            widget = node.get_widget()
+            widget.expanded = True
+            widget.update_expanded_icon()
+            node = node.get_child_node(key)
+        return node
+
+    def match_select(self, string, next_match=False):
+        if (node := self.find(string, next_match)):
+            log.debug(node.get_key())
+            self.set_focus(node)
+        return node